@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+
+# cdgbench - headless CDG decode and display benchmark
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+
+# OVERVIEW
+#
+# cdgbench measures how fast pycdg decodes and displays CDG graphics,
+# and checks that it still draws exactly the same pictures.  It needs
+# neither a display nor a sound card: SDL's dummy video and audio
+# drivers are used throughout.
+#
+# A handful of synthetic CDG streams are generated from fixed random
+# seeds, each one weighted towards a different kind of instruction
+# (tile blocks, XOR blocks, scrolls, colour table changes).  For each
+# stream we report:
+#
+# . the packets/sec decoded by CdgPacketReader.DoPackets() alone, and
+# . the frames/sec achieved by cdgPlayer.cdgDisplayUpdate(), in each
+#   of the zoom modes, when fed a frame's worth of packets at a time.
+#
+# After every displayed frame the CRC32 of the display contents is
+# compared with the golden values stored in cdgbench.golden.  A decoder
+# or renderer change should leave all of these unchanged; run with
+# --update-golden to record new values when a change of output is
+# intended.  The golden values depend on the display size and on
+# pygame's rotozoom, so they are only comparable on the same pygame
+# version.
+#
+# In the soft zoom mode, where only the dirty tiles are scaled when it
+# is quicker (see cdgPlayer.computeSoftTiles()), every frame is also
+# compared with the whole of the working surface scaled at once, as the
+# player used to draw every frame.  No colour component may differ by
+# more than SOFT_MAX_DIFF levels.  This needs the Numeric module, and
+# is skipped without it.
+#
+# USAGE
+#
+#   python cdgbench.py [options]
+#
+# See python cdgbench.py --help for the options.
+
+import os
+import sys
+
+# These must be set before pygame is initialised.
+os.environ['SDL_VIDEODRIVER'] = 'dummy'
+os.environ['SDL_AUDIODRIVER'] = 'dummy'
+
+import json
+import random
+import shutil
+import tempfile
+import time
+import zlib
+from optparse import OptionParser
+
+import pygame
+import pycdg
+
+# The streams to generate: name, seed, and the relative weight of each
+# kind of packet.
+STREAMS = [
+    ('lyrics',  1, [('empty', 30), ('preset', 1), ('border', 1), ('tile', 20),
+                    ('xor', 10), ('scroll', 1), ('palette', 1), ('transp', 1)]),
+    ('xor',     2, [('empty', 10), ('preset', 1), ('tile', 10), ('xor', 30)]),
+    ('scroll',  3, [('empty', 10), ('preset', 1), ('tile', 10), ('scroll', 20)]),
+    ('palette', 4, [('empty', 10), ('preset', 1), ('tile', 10), ('palette', 20)]),
+]
+
+ZOOMS = ['none', 'quick', 'soft']
+
+# Packets per displayed frame; at 300 packets/sec this is 30 frames/sec,
+# the same rate as cdgPlayer.ms_per_update.
+PACKETS_PER_FRAME = 10
+
+# The most that a colour component of a soft zoom frame may differ
+# from scaling the whole screen at once.  A tile's samples may be up to
+# pycdg.SOFT_TILE_ERROR source pixels out along each axis, which between
+# full-range neighbouring pixels is that fraction of 255 levels each;
+# allow a level more each for rounding.  A tile out of place by as much
+# as a whole source pixel would be far beyond this.
+SOFT_MAX_DIFF = int(2 * pycdg.SOFT_TILE_ERROR * 255) + 2
+
+GOLDEN_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'cdgbench.golden')
+
+def cdgPacket(inst, data):
+    data = list(data) + [0] * (16 - len(data))
+    return chr(pycdg.aux_python.CDG_COMMAND) + chr(inst) + '\0\0' + \
+           ''.join([chr(b & 0xFF) for b in data]) + '\0' * 4
+
+def cdgStream(seed, numPackets, mix):
+    """ Returns a string holding numPackets packets of synthetic CDG
+    data, chosen at random according to the weights in mix. """
+
+    aux = pycdg.aux_python
+    rng = random.Random(seed)
+
+    def colourTable(which):
+        data = []
+        for i in range(8):
+            data += [rng.randint(0, 63), rng.randint(0, 63)]
+        return cdgPacket(aux.CDG_INST_LOAD_COL_TBL_0_7 + which, data)
+
+    def tileBlock(inst):
+        data = [rng.randint(0, 15), rng.randint(0, 15),
+                rng.randint(0, 17), rng.randint(0, 49)]
+        data += [rng.randint(0, 63) for i in range(12)]
+        return cdgPacket(inst, data)
+
+    def scroll():
+        hScroll = (rng.choice([0, 1, 2]) << 4) | rng.randint(0, 7)
+        vScroll = (rng.choice([0, 1, 2]) << 4) | rng.randint(0, 15)
+        inst = rng.choice([aux.CDG_INST_SCROLL_PRESET, aux.CDG_INST_SCROLL_COPY])
+        return cdgPacket(inst, [rng.randint(0, 15), hScroll, vScroll])
+
+    kinds = []
+    for kind, weight in mix:
+        kinds += [kind] * weight
+
+    packets = [colourTable(0), colourTable(1)]
+    while len(packets) < numPackets:
+        kind = rng.choice(kinds)
+        if kind == 'empty':
+            packets.append('\0' * 24)
+        elif kind == 'preset':
+            # Real discs repeat the preset a few times in a row.
+            colour = rng.randint(0, 15)
+            for repeat in range(rng.randint(1, 4)):
+                packets.append(cdgPacket(aux.CDG_INST_MEMORY_PRESET, [colour, repeat]))
+        elif kind == 'border':
+            packets.append(cdgPacket(aux.CDG_INST_BORDER_PRESET, [rng.randint(0, 15)]))
+        elif kind == 'tile':
+            packets.append(tileBlock(aux.CDG_INST_TILE_BLOCK))
+        elif kind == 'xor':
+            packets.append(tileBlock(aux.CDG_INST_TILE_BLOCK_XOR))
+        elif kind == 'scroll':
+            packets.append(scroll())
+        elif kind == 'palette':
+            packets.append(colourTable(rng.randint(0, 1)))
+        elif kind == 'transp':
+            packets.append(cdgPacket(aux.CDG_INST_DEF_TRANSP_COL, [rng.randint(0, 15)]))
+    return ''.join(packets[:numPackets])
+
+def benchDecoder(cdgData, paletted):
+    """ Decodes the whole stream a frame at a time and returns the
+    packets/sec achieved. """
+
+    if paletted:
+        mapperSurface = pygame.Surface((pycdg.TILE_WIDTH, pycdg.TILE_HEIGHT), 0, 8)
+    else:
+        mapperSurface = pygame.Surface((pycdg.TILE_WIDTH, pycdg.TILE_HEIGHT), 0, 32)
+    reader = pycdg.aux_python.CdgPacketReader(cdgData, mapperSurface)
+    numPackets = len(cdgData) / 24
+
+    start = time.time()
+    while reader.DoPackets(PACKETS_PER_FRAME):
+        pass
+    elapsed = time.time() - start
+    return numPackets / max(elapsed, 1e-6)
+
+def softZoomDiff(player):
+    """ Returns the largest difference of any colour component
+    between the display and the whole of the player's working surface
+    scaled at once, as it is in 'soft' zoom mode. """
+
+    N = pycdg.N
+    scaled = pygame.transform.rotozoom(player.workingSurface, 0, player.displayScale)
+    width, height = scaled.get_size()
+    drawn = player.display.subsurface(
+        (player.displayRowOffset, player.displayColOffset, width, height))
+    a = N.fromstring(pygame.image.tostring(scaled, 'RGB'), N.UnsignedInt8).astype(N.Int)
+    b = N.fromstring(pygame.image.tostring(drawn, 'RGB'), N.UnsignedInt8).astype(N.Int)
+    return int(N.maximum.reduce(N.absolute(a - b)))
+
+def benchDisplay(cdgPath, zoom, size):
+    """ Plays the stream through cdgPlayer.cdgDisplayUpdate() in the
+    indicated zoom mode, and returns (frames/sec, list of per-frame
+    display CRCs, list of per-frame softZoomDiff() values).  The
+    last is None except in 'soft' zoom mode with Numeric. """
+
+    # The player is rather chatty.
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        player = pycdg.cdgPlayer(cdgPath, size = size)
+        player.cdgZoom = zoom
+        player.computeDisplaySize()
+        reader = player.packetReader
+
+        crcs = []
+        diffs = None
+        if zoom == 'soft' and pycdg.N is not None:
+            diffs = []
+        elapsed = 0
+        while reader.DoPackets(PACKETS_PER_FRAME):
+            start = time.time()
+            player.cdgDisplayUpdate()
+            elapsed += time.time() - start
+            crcs.append(zlib.crc32(pygame.image.tostring(player.display, 'RGB')) & 0xFFFFFFFFL)
+            if diffs is not None:
+                diffs.append(softZoomDiff(player))
+        player.shutdown()
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    return len(crcs) / max(elapsed, 1e-6), crcs, diffs
+
+def main():
+    parser = OptionParser(usage = "%prog [options]")
+    parser.add_option('-n', '--packets', dest = 'packets', type = 'int',
+                      default = 6000,
+                      help = 'number of packets in each stream (default %default)')
+    parser.add_option('-s', '--size', dest = 'size', default = '640x480',
+                      help = 'display size WxH (default %default)')
+    parser.add_option('-z', '--zoom', dest = 'zooms', action = 'append',
+                      help = 'zoom mode to benchmark; may be repeated (default %s)' % ', '.join(ZOOMS))
+    parser.add_option('-g', '--golden', dest = 'golden', default = GOLDEN_FILE,
+                      help = 'golden checksum file (default %default)')
+    parser.add_option('--update-golden', dest = 'update', action = 'store_true',
+                      default = False,
+                      help = 'record the checksums as the new golden values')
+    options, args = parser.parse_args()
+
+    width, height = options.size.split('x')
+    size = (int(width), int(height))
+    zooms = options.zooms or ZOOMS
+
+    # The golden values are keyed by the settings which change them.
+    golden = {}
+    if os.path.exists(options.golden):
+        f = open(options.golden, 'r')
+        try:
+            golden = json.load(f)
+        finally:
+            f.close()
+
+    # cdgPlayer wants a sound file to go with the CDG file; any mp3
+    # will do, since it is never played.
+    tempdir = tempfile.mkdtemp()
+    failures = 0
+    try:
+        shutil.copy(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake.mp3'),
+                    os.path.join(tempdir, 'bench.mp3'))
+        cdgPath = os.path.join(tempdir, 'bench.cdg')
+
+        for name, seed, mix in STREAMS:
+            cdgData = cdgStream(seed, options.packets, mix)
+            f = open(cdgPath, 'wb')
+            try:
+                f.write(cdgData)
+            finally:
+                f.close()
+
+            print "%-8s decode  rgb %9.0f packets/sec  palette %9.0f packets/sec" % (
+                name, benchDecoder(cdgData, False), benchDecoder(cdgData, True))
+
+            for zoom in zooms:
+                fps, crcs, diffs = benchDisplay(cdgPath, zoom, size)
+                key = '%s/%d/%s/%dx%d' % (name, options.packets, zoom, size[0], size[1])
+                if options.update:
+                    golden[key] = crcs
+                    status = 'recorded'
+                elif key not in golden:
+                    status = 'no golden'
+                elif golden[key] == crcs:
+                    status = 'ok'
+                else:
+                    failures += 1
+                    expected = golden[key]
+                    frame = 0
+                    while frame < min(len(crcs), len(expected)) and \
+                          crcs[frame] == expected[frame]:
+                        frame += 1
+                    status = 'MISMATCH at frame %d' % frame
+                if diffs:
+                    worst = max(diffs)
+                    if worst > SOFT_MAX_DIFF:
+                        failures += 1
+                        status += ', DIFFERS from whole screen by %d at frame %d' % (
+                            worst, diffs.index(worst))
+                    else:
+                        status += ', within %d of whole screen' % worst
+                print "%-8s %-6s %9.1f frames/sec  %s" % (name, zoom, fps, status)
+    finally:
+        shutil.rmtree(tempdir)
+
+    if options.update:
+        f = open(options.golden, 'w')
+        try:
+            json.dump(golden, f, sort_keys = True)
+        finally:
+            f.close()
+
+    if failures:
+        print "%d checksum mismatches or soft zoom differences" % failures
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
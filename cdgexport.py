@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+
+# cdgexport - render a CDG file to video frames, headless
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+
+# OVERVIEW
+#
+# cdgexport draws the graphics of a CDG song with pycdg, as fast as the
+# machine can manage rather than in real time, and writes them out as
+# a YUV4MPEG2 stream or as raw 24-bit RGB frames.  These can be put
+# together with the song's sound file by a video encoder, so that a set
+# can be rendered in advance for a machine that cannot play CDG files
+# smoothly itself.  Like cdgbench, it needs neither a display nor a
+# sound card: SDL's dummy video and audio drivers are used.
+#
+# Only the CDG file is needed: the sound file is neither played nor
+# looked for, so it need not be next to the CDG file (or in the same
+# zip) as it must be for playing.
+#
+# USAGE
+#
+#   python cdgexport.py [options] <CDG file>
+#
+# For example, to make an MP4 of a song:
+#
+#   python cdgexport.py -o - song.cdg | \
+#       ffmpeg -i - -i song.mp3 -c:v libx264 -c:a aac -shortest song.mp4
+#
+# and for raw frames, tell the encoder their size and rate:
+#
+#   python cdgexport.py -f rgb -s 640x480 -r 30 -o song.rgb song.cdg
+#   ffmpeg -f rawvideo -pix_fmt rgb24 -s 640x480 -r 30 -i song.rgb \
+#       -i song.mp3 -c:v libx264 -c:a aac -shortest song.mp4
+#
+# See python cdgexport.py --help for the options.
+
+import os
+import sys
+
+# These must be set before pygame is initialised.
+os.environ['SDL_VIDEODRIVER'] = 'dummy'
+os.environ['SDL_AUDIODRIVER'] = 'dummy'
+# Nor may pygame greet us on standard output.
+os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = '1'
+
+import time
+from optparse import OptionParser
+
+import pycdg
+
+def main():
+    parser = OptionParser(usage = "%prog [options] <CDG file>")
+    parser.add_option('-o', '--output', dest = 'output',
+                      help = 'file to write the frames to, or - for standard output (default: the CDG file name with the format as extension)')
+    parser.add_option('-f', '--format', dest = 'format', default = 'y4m',
+                      choices = pycdg.DUMP_FORMATS,
+                      help = 'frame format: %s (default %%default)' % ', '.join(pycdg.DUMP_FORMATS))
+    parser.add_option('-s', '--size', dest = 'size', default = '640x480',
+                      help = 'frame size WxH (default %default)')
+    parser.add_option('-r', '--frame-rate', dest = 'frameRate', type = 'int',
+                      default = pycdg.DEFAULT_FRAME_RATE,
+                      help = 'frames per second (default %default)')
+    parser.add_option('-z', '--zoom', dest = 'zoom', default = 'soft',
+                      choices = ['none', 'quick', 'int', 'full', 'soft'],
+                      help = 'zoom mode (default %default)')
+    parser.add_option('-Z', '--zip', dest = 'zippath',
+                      help = 'zip archive the CDG file is in')
+    parser.add_option('-d', '--delay', dest = 'delay', type = 'int', default = 0,
+                      help = 'graphics offset in milliseconds (default %default)')
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.print_help()
+        return 2
+    cdgfile = args[0]
+
+    if options.frameRate <= 0:
+        parser.error('the frame rate must be positive')
+
+    try:
+        width, height = options.size.split('x')
+        size = (int(width), int(height))
+    except ValueError:
+        parser.error('the frame size must be WxH, such as 640x480')
+    if size[0] <= 0 or size[1] <= 0:
+        parser.error('the frame size must be positive')
+    if options.format == 'y4m' and (size[0] % 2 or size[1] % 2):
+        parser.error('the y4m format needs an even width and height')
+
+    # The player is rather chatty, and the frames may be going to
+    # standard output.
+    stdout = sys.stdout
+    sys.stdout = sys.stderr
+    try:
+        try:
+            player = pycdg.cdgPlayer(cdgfile, size = size,
+                                     zippath = options.zippath,
+                                     offsetTime = options.delay,
+                                     frameRate = options.frameRate,
+                                     sound = False)
+        except Exception, e:
+            sys.stderr.write("Cannot open %s: %s\n" % (cdgfile, e))
+            return 1
+        player.cdgZoom = options.zoom
+        player.computeDisplaySize()
+
+        # Only now that the song is open do we make the output, so
+        # that a song we cannot open leaves nothing behind.
+        output = None
+        if options.output == '-':
+            if os.name == 'nt':
+                import msvcrt
+                msvcrt.setmode(stdout.fileno(), os.O_BINARY)
+            dumpFile = stdout
+        else:
+            output = options.output
+            if not output:
+                output = os.path.splitext(os.path.basename(cdgfile))[0] + '.' + options.format
+            try:
+                dumpFile = open(output, 'wb')
+            except IOError, e:
+                player.shutdown()
+                sys.stderr.write("Cannot write %s: %s\n" % (output, e))
+                return 1
+
+        try:
+            start = time.time()
+            player.Capture(dumpFile, options.format, options.frameRate)
+            player.WaitForPlayer()
+            elapsed = time.time() - start
+        except Exception, e:
+            player.shutdown()
+            if output:
+                # Don't leave a partial file behind (but only a file:
+                # the output may be a device or a pipe).
+                dumpFile.close()
+                if os.path.isfile(output):
+                    os.remove(output)
+            sys.stderr.write("Cannot export %s: %s\n" % (cdgfile, e))
+            return 1
+        if output:
+            dumpFile.close()
+    finally:
+        sys.stdout = stdout
+
+    frames = player.framesDumped
+    sys.stderr.write("%d frames (%.1f seconds) in %.1f seconds, %.1f frames/sec\n" % (
+        frames, frames / float(options.frameRate), elapsed,
+        frames / max(elapsed, 1e-6)))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
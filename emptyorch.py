@@ -1,17 +1,15 @@
 import os
 import re
 import sys
-import stat
-import glob
 import time
 import Queue
 import pickle
 import socket
 import random
 import urllib2
-import zipfile
 import threading
 import webbrowser
+import multiprocessing
 import subprocess
 import ConfigParser
 
@@ -21,20 +19,16 @@ import wx.gizmos as gizmos
 import wx.lib.mixins.listctrl  as  listmix
 from wx import xrc
 
-import mutagen.id3
-from mutagen.mp3 import MP3
-from mutagen.oggvorbis import OggVorbis
-from mutagen.easyid3 import EasyID3
-from mutagen.id3 import ID3NoHeaderError
-
-import pygame
-
 import emptyorch_xrc
 from eo_widgets import Playlist_list 
 from eo_print import SongPrinter
 import eo_web
+import eo_cache
+import eo_meta
+import eo_watch
+import eo_playerproc
 
-from pycdg import cdgPlayer
+from pycdg import DEFAULT_FRAME_RATE
 from pykconstants import *
 
 DATADIR = os.path.dirname(emptyorch_xrc.__file__)
@@ -42,6 +36,10 @@ if os.path.basename(DATADIR) == "library.zip":
     # If we are using a frozen package set the DATADIR
     DATADIR = os.path.dirname(DATADIR)
 
+# How long (in seconds) to wait after the song list changes before
+# saving it, so that a run of changes is saved once.
+SAVE_DELAY = 10.0
+
 def _fix_my_import(name):
     """_fix_my_import  Fix issue specific to nt"""
     try:
@@ -64,18 +62,6 @@ if os.name == "nt":
     xrc._my_import = _fix_my_import
 
 
-class cdgAppPlayer(cdgPlayer):
-    """cdgAppPlayer Override for NT specific issues"""
-    def shutdown(self):
-        """ shutdown Override shutdown for NT"""
-        if os.name == 'nt':
-            # Must load another mp3 for pygame since it never wants to
-            # release the file and we want to cleanup the temp dir.
-            pygame.mixer.music.load(os.path.join(DATADIR, 'fake.mp3'))
-
-        cdgPlayer.shutdown(self)
-
-
 class EmptyOrch(wx.App, eo_web.MyTCPServer):
     """ EmptyOrch
 
@@ -83,18 +69,38 @@ class EmptyOrch(wx.App, eo_web.MyTCPServer):
     to serve all your karaoke dreams.
     """
 
-    kar_exts = ('.cdg', '.kar')
-    media_exts = ('.mp3','.ogg', '.avi', '.mpg')
+    kar_exts = eo_meta.KAR_EXTS
+    media_exts = eo_meta.MEDIA_EXTS
+    song_headers = ['Artist', 'Title', 'Genre', 'Type', 'Path', 'Archive']
     songdata = []
+    # The song list as the scans leave it, which the list on screen
+    # is brought up to, and when it was last scanned.
+    songs = []
+    scantime = 0
+    audioinfo = {}
+    libindex = {}
+    ziplistings = {}
     player = None
-    playthread = None
+    scanpool = None
     scanthread = None
     scandirs = []
+    # Held while the song list is brought up to date, by the scan
+    # thread or the library watcher.
+    scanlock = threading.Lock()
+    saveTimer = None
+    watcher = None
     keep_serving = True
+    slider_dragging = False
     webthread = None
 
-    def __init__(self, *kwds, **args):
-        """ __init__  Initialize the application"""
+    def __init__(self, player, *kwds, **args):
+        """ __init__  Initialize the application.  player is the
+        eo_playerproc.PlayerProcess, which must be started before the
+        wx.App is made."""
+        self.player = player
+        # The scanner processes must be started before wx is, too.
+        self.get_settings()
+        self.scanpool = eo_meta.ScanPool(self.scanProcs)
         wx.App.__init__(self, *kwds, **args)
         eo_web.MyTCPServer.__init__(self, ("", 8080), eo_web.MyRequestHandler)
 
@@ -102,22 +108,37 @@ class EmptyOrch(wx.App, eo_web.MyTCPServer):
         """OnInit   Some WxPythony initilization"""
         # Get the XRC Resource
         self.res = xrc.XmlResource(os.path.join(DATADIR, 'emptyorch.xrc'))
-        self.get_settings()
+        # Songs in zip archives are extracted to the cache directory,
+        # and kept for the next time they are sung.
+        self.player.SetCache(
+            os.path.join(self.eo_dir, 'cache'),
+            self.cacheSize * 1024 * 1024
+        )
         self.init_frame()
         if not self.scandirs:
             self.setScanDir()
         self.scanthread = threading.Thread(target=self.scanDirs)
         self.scanthread.start()
+        self.startWatcher()
         time.sleep(1)
         return True
 
     def OnExit(self):
         """OnExit   Exit cleanly and save settings"""
+        if self.watcher:
+            self.watcher.Stop()
         self.scanthread.join()
-        if self.player:
-            self.cdgSize = self.player.displaySize
-            self.fullscreen = self.player.fullScreen
-            self.delay = self.player.InternalOffsetTime
+        self.scanlock.acquire()
+        try:
+            if self.saveTimer:
+                self.saveTimer.cancel()
+                self._saveLibrary()
+        finally:
+            self.scanlock.release()
+        self.scanpool.Close()
+        self.player.Poll()
+        self.savePlayerSettings()
+        self.player.Close()
         self.set_settings()       
     #    self.timer.Stop()
 
@@ -137,6 +158,18 @@ class EmptyOrch(wx.App, eo_web.MyTCPServer):
             self.eo_dir,
             '.musicdata'
         )
+        self.audioinfo_path = os.path.join(
+            self.eo_dir,
+            '.audioinfo'
+        )
+        self.libindex_path = os.path.join(
+            self.eo_dir,
+            '.libindex'
+        )
+        self.ziplistings_path = os.path.join(
+            self.eo_dir,
+            '.ziplistings'
+        )
         # Process the settings file
         if os.path.isfile(self.settings_path):
             config = ConfigParser.ConfigParser()
@@ -152,8 +185,35 @@ class EmptyOrch(wx.App, eo_web.MyTCPServer):
                 self.scandirs = eval(config.get('app', 'dirs'))
             except ConfigParser.NoOptionError:
                 self.scandirs = []
+            try:
+                self.frameRate = int(config.get('cdg', 'framerate'))
+            except (ConfigParser.NoOptionError, ValueError):
+                self.frameRate = DEFAULT_FRAME_RATE
+            if self.frameRate <= 0:
+                self.frameRate = DEFAULT_FRAME_RATE
+            try:
+                self.decodeAhead = eval(config.get('cdg', 'decodeahead'))
+            except ConfigParser.NoOptionError:
+                self.decodeAhead = False
+            try:
+                self.cacheSize = int(config.get('app', 'cachesize'))
+            except ConfigParser.NoOptionError:
+                self.cacheSize = eo_cache.DEFAULT_CACHE_SIZE
+            try:
+                self.scanProcs = int(config.get('app', 'scanprocs'))
+            except ConfigParser.NoOptionError:
+                self.scanProcs = 0
+            try:
+                self.watch = eval(config.get('app', 'watch'))
+            except ConfigParser.NoOptionError:
+                self.watch = False
         else:
             self.delay = 0
+            self.frameRate = DEFAULT_FRAME_RATE
+            self.decodeAhead = False
+            self.cacheSize = eo_cache.DEFAULT_CACHE_SIZE
+            self.scanProcs = 0
+            self.watch = False
             self.cdgSize = (640, 480)
             self.cdgPos = (0, 0)
             self.fullscreen = False
@@ -172,10 +232,19 @@ class EmptyOrch(wx.App, eo_web.MyTCPServer):
         config.set('cdg', 'size', str(self.cdgSize))
         config.set('cdg', 'pos', str(self.cdgPos))
         config.set('cdg', 'fullscreen', str(self.fullscreen))
+        config.set('cdg', 'framerate', str(self.frameRate))
+        config.set('cdg', 'decodeahead', str(self.decodeAhead))
         config.add_section('app')
         config.set('app', 'size', str(self.eoAppSize))
         config.set('app', 'pos', str(self.eoAppPos))
         config.set('app', 'dirs', str(self.scandirs))
+        config.set('app', 'cachesize', str(self.cacheSize))
+        # The number of processes reading tags when scanning; 0 for
+        # one per CPU.
+        config.set('app', 'scanprocs', str(self.scanProcs))
+        # Watch the directories for songs coming and going (Linux,
+        # with pyinotify).
+        config.set('app', 'watch', str(self.watch))
         f = open(self.settings_path, 'wb')
         try:
             config.write(f)
@@ -251,6 +320,11 @@ class EmptyOrch(wx.App, eo_web.MyTCPServer):
         self.timer.Start(500)
 
         self.media_list.setupData(self.songdb_path)
+        self.songs = list(self.media_list.rows)
+        self.scantime = self.media_list.scantime
+        self.loadAudioInfo()
+        self.loadLibIndex()
+        self.loadZipListings()
         self.media_list.AddRclickItem(
             "Add to Playlist", self.DoAddPlaylist
         )
@@ -355,6 +429,7 @@ class EmptyOrch(wx.App, eo_web.MyTCPServer):
         self.scanthread.join(1)
         self.scanthread = threading.Thread(target=self.scanDirs)
         self.scanthread.start()
+        self.startWatcher()
 
     def OnMenu_open_menu(self, evt):
         """OnMenu_open_menu   Callback that plays a karaoke file directly.
@@ -398,53 +473,37 @@ class EmptyOrch(wx.App, eo_web.MyTCPServer):
         print "Load File:", path
         self.st_file.SetLabel(os.path.basename(path))
 
-        if self.player:
-            self.player.shutdown()
-
-        if self.playthread:
-            print "Shutting down playthread."
-            self.playthread.join()
-
-        if self.player:
-            self.cdgSize = self.player.displaySize
-            self.fullscreen = self.player.fullScreen
-            self.delay = self.player.InternalOffsetTime
-            print "STATE:", self.player.State
-            if self.player.State == STATE_PLAYING:
-                print "Playing... Shutting down."
-                self.player.shutdown()
-
-            del self.player
-            self.player = None
+        self.player.shutdown()
+        # Pick up the settings last reported for the song that was
+        # playing; anything else it said is now out of date, and is
+        # dropped.
+        self.handlePlayerEvents()
+        self.savePlayerSettings()
 
         if archive == 'web':
             #subprocess.call('vlc --play-and-exit %s' % path, shell=True)
             webbrowser.open("http://localhost:8080/test.html?songid='%s'" % path, new=1)
             return
-        elif archive:
-            self.player = cdgAppPlayer(
-                path, 
-                size = self.cdgSize,
-                fullscreen = self.fullscreen,
-                zippath = archive,
-                offsetTime = self.delay
-            )
-        else:
-            self.player = cdgAppPlayer(
-                path, 
-                size = self.cdgSize, 
-                fullscreen = self.fullscreen,
-                offsetTime = self.delay
-            )
-       
+
+        self.player.Load(
+            path,
+            size = self.cdgSize,
+            fullscreen = self.fullscreen,
+            zippath = archive or None,
+            offsetTime = self.delay,
+            frameRate = self.frameRate,
+            decodeAhead = self.decodeAhead,
+            audioProperties = self.audioinfo.get((path, archive or ''))
+        )
         self.player.Play()
-        if os.name == 'nt':
-            print "PLAYER:", self.player
-            self.player.WaitForPlayer()
-            #self.player.shutdown()
-        else:
-            self.playthread = threading.Thread(target=self.player.WaitForPlayer)
-            self.playthread.start()
+
+    def savePlayerSettings(self):
+        """savePlayerSettings   Keep the window size and sync delay
+        the player last reported, for the next song."""
+        if self.player.displaySize:
+            self.cdgSize = self.player.displaySize
+            self.fullscreen = self.player.fullScreen
+            self.delay = self.player.InternalOffsetTime
 
     def OnButton_addplay_btn(self, evt):
         self.DoAddPlaylist(evt)
@@ -517,14 +576,11 @@ class EmptyOrch(wx.App, eo_web.MyTCPServer):
 
     def OnMedia_finished(self, evt):
         print "Finished!"
-        self.loadNextItem()
+        if self.playlist.getNext():
+            self.loadNextItem()
 
     def OnButton_play_btn(self, evt):
-        if not self.player:
-            self.loadCurItem()
-        else:
-            self.player.shutdown()
-            self.loadCurItem()
+        self.loadCurItem()
 
     def OnButton_pause_btn(self, evt):
         self.player.Pause()
@@ -538,7 +594,35 @@ class EmptyOrch(wx.App, eo_web.MyTCPServer):
     def OnButton_next_btn(self, evt):
         self.loadNextItem()
 
+    def prefetchNext(self):
+        """prefetchNext   Start loading the next song in the playlist
+        in the background, so that it is ready to play as soon as
+        the current one finishes."""
+        entry = self.playlist.getNext()
+        if not entry:
+            return
+        singer, artist, title, path, archive = entry
+        if archive != 'web':
+            self.player.Prefetch(path, archive or None)
+
+    def handlePlayerEvents(self):
+        """handlePlayerEvents   Act on what the player process has
+        reported: a song that has played to the end is followed by
+        the next in the playlist; one closed from the player window
+        is not.  Nothing is reported for a song once another has been
+        loaded, or it has been stopped from here."""
+        for event in self.player.Poll():
+            if event[0] == 'finished':
+                self.OnMedia_finished(None)
+            elif event[0] == 'closed':
+                self.OnMedia_stop(None)
+            elif event[0] == 'error':
+                self._updateStatus(event[1])
+
     def onTimer(self, evt):
+        self.handlePlayerEvents()
+        self.updateSlider()
+        self.prefetchNext()
         try:
             i = self.sync_queue.get(block=False)
             if i:
@@ -549,133 +633,147 @@ class EmptyOrch(wx.App, eo_web.MyTCPServer):
             pass
             #print "No data yet..."
 
+    def updateSlider(self):
+        """updateSlider   Move the position slider to follow the
+        current song, unless the user is dragging it."""
+        if not self.player or self.slider_dragging:
+            return
+        if self.player.State != STATE_PLAYING:
+            return
+        length = self.player.GetLength()
+        if not length:
+            return
+        pos = self.player.GetPos()
+        offset = int(pos * self.slider.GetMax() / (length * 1000.0))
+        self.slider.SetValue(max(0, min(offset, self.slider.GetMax())))
+
     def OnScroll_slider(self, evt):
+        """OnScroll_slider   Seek the current song to the position the
+        slider was moved to.  While the thumb is being dragged we only
+        note that, and seek once it is released."""
+        if evt.GetEventType() == wx.wxEVT_SCROLL_THUMBTRACK:
+            self.slider_dragging = True
+            return
+        self.slider_dragging = False
         offset = self.slider.GetValue()
+        if self.player:
+            length = self.player.GetLength()
+            if length:
+                self.player.Seek(
+                    length * 1000.0 * offset / self.slider.GetMax()
+                )
 
     def OnScroll_volume_sl(self, evt):
         offset = self.volume_sl.GetValue()
         volume = float(offset) / 100.0
         print "VOLUME:", volume
 
-    def getFileInfoFromMeta(self, filepath):
-        artist = ''
-        title = ''
-        genre = ''
-
-        musicfile = self.getMusicForCdg(filepath)
-        if musicfile:
-            name, ext = os.path.splitext(musicfile)
-            print "Name:", name
-            print "Ext:", ext
-            if ext == '.mp3':
-                print "MP3"
-                try:
-                    eid = EasyID3(musicfile)
-                    artist = eid.get('artist', [''])[0]
-                    title = eid.get('title', [''])[0]
-                    genre = eid.get('genre', ['karaoke'])[0]
-                    print "Got: (%s, %s, %s)" % (artist, title, genre)
-                except ID3NoHeaderError:
-                    print "No ID Header for", musicfile
-            elif ext == '.ogg':
-                audio = OggVorbis(musicfile)
-                artist = audio.get('artist', '')[0]
-                title = audio.get('title', '')[0]
-                genre = audio.get('genre', ['karaoke'])[0]
-
-        return artist, title, genre
-
-    def getFileInfoFromRegex(self, file, titleres=None):
-        #print "getFileInfoRegex: %s" % file
-        artist0, title0 = ('','')
-
-        if (not artist0 or not title0) and titleres:
-            for titlere in titleres:
-                results = titlere.match(file) 
-                print "Finding RE: %s for %s" % (results, file)
-                if results:
-                    resdict = results.groupdict()
-                    artist0 = resdict.get('artist', '')
-                    title0 = resdict.get('title', '')
-                    print "RE results %s, %s" % (artist0, title0)
-                    break
-
-        return artist0, title0
-
-    def getFileInfoFromGuess(self, file):
-        #print "getFileInfoFromGuess: %s " % file
-        filebase = os.path.basename(file)
-        title = ""
-        artist = ""
-
-        chunks = filebase.split(" - ")
-        if len(chunks) >= 2:
-            title = chunks[-1].split(".")[0].strip()
-            artist = chunks[-2].strip()
-            #print "' - 'artist:%s, title:%s: " % (artist, title)
-
-        if not title and not artist:
-            chunks = filebase.split("-")
-            if len(chunks) >= 2:
-                title = chunks[-1].split(".")[0].strip()
-                artist = chunks[-2].strip()
-                #print "'-'artist:%s, title:%s: " % (artist, title)
-
-        if not title and not artist:
-            chunks = filebase.split("-")
-            if len(chunks) >= 2:
-                title = chunks[-1].split(".")[0].strip()
-                artist = chunks[-1].strip()
-                #print "' 'artist:%s, title:%s: " % (artist, title)
-
-        return artist, title
-
-    def getFileInfoFromInfo(self, filepath, fileinfo):
-        #print "getFileInfoFromInfo: ",
-        basename = os.path.basename(filepath)
-        title, artist = fileinfo.get(basename, ('', ''))
-        return artist, title
-
-    def getFileInfo(self, filepath, fileinfo, titlere):
-        genre = ''
-        print "Get File Info from Info"
-        artist, title = self.getFileInfoFromInfo(filepath, fileinfo)
-        if not artist or not title:
-            print "Nope.  Get Info From Meta"
-            artist, title, genre = self.getFileInfoFromMeta(filepath)
-        if not artist or not title and titlere:
-            print "Nope.  Get Info From Regex"
-            artist, title = self.getFileInfoFromRegex(filepath, titlere)
-        if not artist or not title:
-            print "Nope.  Get Info From Guess"
-            artist, title = self.getFileInfoFromGuess(filepath)
-        return artist, title, genre
-
-    def getMusicForCdg(self, cdgpath):
-        name, ext = os.path.splitext(cdgpath)
-        candidates = glob.glob("%s.*" % name)
-        musicfile = None
-        for candidate in candidates:
-            name, ext = os.path.splitext(candidate)
-            if ext.lower() in self.media_exts:
-                musicfile = candidate
-                break
-        return musicfile
-
-    def appendSong(self, filepath, songlist, fileinfo, titlere=None):
-        musicfile = self.getMusicForCdg(filepath)
-        if musicfile:
-            name, ext = os.path.splitext(musicfile)
-            artist, title, genre = self.getFileInfo(
-                    filepath, 
-                    fileinfo,
-                    titlere
-            )
-            songlist.append([
-                artist, title, genre, ext, filepath, ''
-            ])
-            print "Adding %s" % filepath
-            self._updateStatus("Adding %s by %s" % (title, artist))
+    def loadAudioInfo(self):
+        """loadAudioInfo   Load the audio properties found by earlier
+        scans, keyed by (path, archive) as in the song list."""
+        if os.path.isfile(self.audioinfo_path):
+            f = open(self.audioinfo_path)
+            try:
+                self.audioinfo = pickle.load(f)
+            finally:
+                f.close()
+
+    def saveAudioInfo(self):
+        f = open(self.audioinfo_path, 'w')
+        try:
+            pickle.dump(self.audioinfo, f)
+        finally:
+            f.close()
+
+    def loadLibIndex(self):
+        """loadLibIndex   Load the index of the files found by earlier
+        scans, keyed by (path, archive) as in the song list, and by
+        (path, '') for the zip archives themselves.  A zip archive has
+        its (size, mtime); a song has (fingerprint, sound), where
+        fingerprint is its (size, mtime), or (size, CRC) from the
+        archive's directory for a zip member, and sound is (path,
+        fingerprint) for the sound file that goes with it, or None."""
+        if os.path.isfile(self.libindex_path):
+            f = open(self.libindex_path)
+            try:
+                self.libindex = pickle.load(f)
+            finally:
+                f.close()
+
+    def saveLibIndex(self):
+        f = open(self.libindex_path, 'w')
+        try:
+            pickle.dump(self.libindex, f)
+        finally:
+            f.close()
+
+    def loadZipListings(self):
+        """loadZipListings   Load the directories of the zip archives
+        found by earlier scans: (fingerprint, listing) keyed by the
+        archive's path, where fingerprint is its (size, mtime) and
+        listing is as from eo_meta.getZipListing()."""
+        if os.path.isfile(self.ziplistings_path):
+            f = open(self.ziplistings_path)
+            try:
+                self.ziplistings = pickle.load(f)
+            finally:
+                f.close()
+
+    def saveZipListings(self):
+        f = open(self.ziplistings_path, 'w')
+        try:
+            pickle.dump(self.ziplistings, f)
+        finally:
+            f.close()
+
+    def getZipListing(self, path, fingerprint):
+        """getZipListing   Returns the directory of the zip archive at
+        path, from the cache if it has the same fingerprint as when it
+        was last read."""
+        cached = self.ziplistings.get(path)
+        if cached and cached[0] == fingerprint:
+            return cached[1]
+        listing = eo_meta.getZipListing(path)
+        self.ziplistings[path] = (fingerprint, listing)
+        return listing
+
+    def getFingerprint(self, st):
+        """getFingerprint   Returns the fingerprint of a file for the
+        index, from its os.stat() result."""
+        return (st.st_size, int(st.st_mtime))
+
+    def isIndexed(self, key, fingerprint, known):
+        """isIndexed   Records the fingerprint of a file (or zip
+        member) in the index, and returns True if it is in the song
+        list and has not changed since the last scan."""
+        old = self.libindex.get(key)
+        self.libindex[key] = fingerprint
+        # Songs listed before there was an index are taken as they
+        # are.
+        return key in known and old in (fingerprint, None)
+
+    def startWatcher(self):
+        """startWatcher   Starts watching the scan directories, if
+        the watch setting is on, so that songs added to them or taken
+        away are added to the song list or dropped from it as they
+        come and go (see eo_watch)."""
+        if self.watcher:
+            self.watcher.Stop()
+            self.watcher = None
+        if not self.watch:
+            return
+        if not eo_watch.isAvailable():
+            print "Cannot watch the song directories without pyinotify."
+            return
+        self.watcher = eo_watch.LibraryWatcher(self.scandirs, self.updateSongs)
+        self.watcher.Start()
+
+    def updateSongs(self, paths):
+        """updateSongs   Called by the library watcher with the
+        paths that have changed."""
+        print "Updating: %s" % ', '.join(paths)
+        self.scanPaths(paths)
+        self._updateStatus("Found %s Songs" % len(self.songs))
 
     def scanDirs(self):
         print "ScanDirs"
@@ -684,131 +782,352 @@ class EmptyOrch(wx.App, eo_web.MyTCPServer):
             self.findKaraoke(scandir)
 
     def findKaraoke(self, path):
-        curRows = self.media_list.rows
-        curPaths = map(lambda x: x[4], curRows)
+        """findKaraoke   Scans path for songs, adding the new ones to
+        the song list, reading the changed ones again and dropping
+        those that have gone (see scanPaths)."""
         self._updateStatus("Scanning: %s" % path)
-        mtime = os.stat(path)[stat.ST_MTIME]
-        #if mtime < self.media_list.scantime:
-        #    print "%s is already up to date." % path
-        #    self.frm.SetStatusText("%s is already up to date." % path)
-        #    return
-
-        #self.doLoadFile(self.file_tree.GetFilePath())
-        title_res = []
+        self.scanPaths([path])
+        self._updateStatus("Found %s Songs" % len(self.songs))
+        print "Done scanning."
+
+    def scanPaths(self, paths):
+        """scanPaths   Brings the song list up to date with paths: the
+        songs under those that are directories, and those that are
+        files (songs, sound files or zip archives), or have gone.
+        Only files that are not in the index with the same size and
+        modification time are looked at; their tags are read by a
+        pool of scanProcs processes (see eo_meta.ScanPool).  The library
+        watcher (see eo_watch) calls this with the files it has seen
+        change, so that nothing else is walked."""
+        self.scanlock.acquire()
+        try:
+            self._scanPaths(paths)
+        finally:
+            self.scanlock.release()
+
+    def _scanPaths(self, paths):
+        # The songs we already have, by (path, archive), and the keys
+        # of those in each archive.
+        known = {}
+        archives = {}
+        for row in self.songs:
+            key = (row[4], row[5])
+            known[key] = row
+            if row[5]:
+                archives.setdefault(row[5], []).append(key)
+
         songdata = []
-        fileinfo = {}
-        for root, dirs, files in os.walk(path):
-            
-            cur_mtime = os.stat(root)[stat.ST_MTIME]
-            if cur_mtime < self.media_list.scantime:
+        # The songs to read, for eo_meta.readSong().
+        jobs = []
+        # The index keys found in this scan: True if unchanged.
+        seen = {}
+        # The files and directories looked at; what was in them and
+        # has not been seen has gone.
+        files = {}
+        prefixes = []
+        for path in paths:
+            if os.path.isdir(path):
+                prefixes.append(os.path.join(path, ''))
+                # The titles files apply to the directories below
+                # them too.
+                fileinfo = {}
+                title_res = self.readTitleDirs(self.getTitleDirs(path)[:-1],
+                                               fileinfo, [])
+                for root, dirs, names in os.walk(path):
+                    title_res = self.readTitleFiles(root, names, fileinfo,
+                                                    title_res)
+                    self.checkFiles(root, names, names, known, archives,
+                                    seen, jobs, fileinfo, title_res)
                 continue
+
+            root, name = os.path.split(path)
+            stem, ext = os.path.splitext(name)
+            if not os.path.exists(path):
+                # It may have been a directory.
+                prefixes.append(os.path.join(path, ''))
+            try:
+                names = os.listdir(root)
+            except OSError:
+                names = []
+            if ext in self.media_exts:
+                # Read the songs that go with a sound file again.
+                checks = [stem + kext for kext in self.kar_exts]
+                force = True
+            elif name in ('titles.txt', 'titlere.txt'):
+                checks = names
+                force = True
             else:
-                print "CURMTIME:", cur_mtime
-                print "SCANTIME:", self.media_list.scantime
-                print "Detected modification for %s" % root
-                
-            # Check each dir to see if there is a titles file
+                checks = [name]
+                force = False
+            for check in checks:
+                files[os.path.join(root, check)] = True
+            fileinfo = {}
+            title_res = self.readTitleDirs(self.getTitleDirs(root),
+                                           fileinfo, [])
+            self.checkFiles(root, names, [c for c in checks if c in names],
+                            known, archives, seen, jobs, fileinfo, title_res,
+                            force)
+
+        read = {}
+        for songs in self.scanpool.ReadSongs(jobs):
+            for row, audioinfo in songs:
+                print "Adding %s" % row[4]
+                self._updateStatus("Adding %s by %s" % (row[1], row[0]))
+                songdata.append(row)
+                read[(row[4], row[5])] = True
+                self.audioinfo[(row[4], row[5])] = audioinfo
+
+        def scanned(key):
+            path = key[1] or key[0]
+            if path in files:
+                return True
+            for prefix in prefixes:
+                if path.startswith(prefix):
+                    return True
+            return False
+
+        # Keep the songs elsewhere and the ones that have not changed;
+        # the changed ones have been read again, into songdata.
+        rows = []
+        removed = {}
+        for row in self.songs:
+            key = (row[4], row[5])
+            if seen.get(key) or not scanned(key):
+                rows.append(row)
+                continue
+            removed[key] = True
+            if key not in read:
+                print "Dropping %s" % row[4]
+                self.audioinfo.pop(key, None)
+        for key in self.libindex.keys():
+            if key not in seen and scanned(key):
+                del self.libindex[key]
+        for path in self.ziplistings.keys():
+            if (path, '') not in seen and scanned((path, '')):
+                del self.ziplistings[path]
+
+        self.songs = rows + songdata
+        self.scantime = time.time()
+        if songdata or removed:
+            wx.CallAfter(self.updateList, songdata, removed, self.scantime)
+        self.scheduleSave()
+
+    def updateList(self, added, removed, scantime):
+        """updateList   Brings the song list on screen up to date
+        after a scan: the rows in added are new, and those with the
+        (path, archive) keys in removed have gone or been read again.
+        Only call this from the main thread."""
+        self.media_list.scantime = scantime
+        self.media_list.UpdateData(
+            added,
+            lambda row: (row[4], row[5]) in removed
+        )
+
+    def scheduleSave(self):
+        """scheduleSave   Saves the song list and what the scans
+        know about the files SAVE_DELAY seconds from now, or later if
+        there is another change before then.  Call it with scanlock
+        held."""
+        if self.saveTimer:
+            self.saveTimer.cancel()
+        self.saveTimer = threading.Timer(SAVE_DELAY, self.saveLibrary)
+        self.saveTimer.daemon = True
+        self.saveTimer.start()
+
+    def saveLibrary(self):
+        """saveLibrary   Called by the save timer (see scheduleSave)."""
+        self.scanlock.acquire()
+        try:
+            if self.saveTimer is threading.currentThread():
+                self._saveLibrary()
+        finally:
+            self.scanlock.release()
+
+    def _saveLibrary(self):
+        self.saveTimer = None
+        self.saveSongs()
+        self.saveAudioInfo()
+        self.saveLibIndex()
+        self.saveZipListings()
+
+    def saveSongs(self):
+        """saveSongs   Saves the song list the scans have left, as
+        the song list on screen does (see SortVirtList.SaveData)."""
+        f = open(self.songdb_path, 'w')
+        try:
+            pickle.dump((self.scantime, self.song_headers, self.songs), f)
+        finally:
+            f.close()
+
+    def getTitleDirs(self, path):
+        """getTitleDirs   Returns the directories whose titles files
+        apply to the songs in path: those from the scan directory it
+        is in down to path itself."""
+        for scandir in self.scandirs:
+            scandir = os.path.join(scandir, '')
+            if os.path.join(path, '').startswith(scandir):
+                dirs = [scandir[:-1]]
+                for part in path[len(scandir):].split(os.sep):
+                    if part:
+                        dirs.append(os.path.join(dirs[-1], part))
+                return dirs
+        return [path]
+
+    def readTitleDirs(self, dirs, fileinfo, title_res):
+        """readTitleDirs   Reads the titles files in each of dirs in
+        turn (see readTitleFiles)."""
+        for titledir in dirs:
+            names = [name for name in ('titles.txt', 'titlere.txt')
+                     if os.path.isfile(os.path.join(titledir, name))]
+            title_res = self.readTitleFiles(titledir, names, fileinfo,
+                                            title_res)
+        return title_res
+
+    def readTitleFiles(self, root, names, fileinfo, title_res):
+        """readTitleFiles   Reads the titles files in the directory
+        root, whose files are names, into fileinfo, and returns the
+        title regular expressions: those in titlere.txt if there is
+        one, else title_res."""
+        # Check each dir to see if there is a titles file
+        if 'titles.txt' in names:
             title_file = os.path.join(root, "titles.txt")
-            if os.path.isfile(title_file):
-                print "Found %s" % title_file
-                f = open(title_file)
-                try:
-                    titledata = f.readlines()
-                    for line in titledata:
-                        chunks = line.split('|')
-                        if len(chunks) < 3:
-                            continue
-                        else:
-                            # Index on the path, return tuple of
-                            # Title, Artist
-                            fileinfo[chunks[0]] = (
-                                chunks[1].strip(),
-                                chunks[2].strip()
-                            )
-                finally:
-                    f.close()
-
-            # See if we have a title_re file
-            title_re_file = os.path.join(root, 'titlere.txt')
-            if os.path.isfile(title_re_file):
-                print "Found titlere.txt"
-                title_res = []
-                f = open(title_re_file)
-                try:
-                    redata = f.readlines()
-                finally:
-                    f.close()
-                for titlere in redata:
-                    title_res.append(re.compile(titlere.strip()))
-
-            for file in files:
-                filepath = os.path.join(root, file)
-                #print "FILEPATH: %s" % filepath
-                if filepath in curPaths:
-                    #print "Already have entry for: %s" % filepath
-                    continue
-                name, ext = os.path.splitext(file)
-                #print "(%s, %s)" % (name, ext)
-                if ext in self.kar_exts:
-                    self.appendSong(filepath, songdata, fileinfo, title_res)
-                if ext == '.zip':
-                    if zipfile.is_zipfile(filepath):
-                        self.findInZip(
-                            filepath, 
-                            songdata, 
-                            curPaths, 
-                            fileinfo,
-                            title_res
+            print "Found %s" % title_file
+            f = open(title_file)
+            try:
+                titledata = f.readlines()
+                for line in titledata:
+                    chunks = line.split('|')
+                    if len(chunks) < 3:
+                        continue
+                    else:
+                        # Index on the path, return tuple of
+                        # Title, Artist
+                        fileinfo[chunks[0]] = (
+                            chunks[1].strip(),
+                            chunks[2].strip()
                         )
+            finally:
+                f.close()
 
-        self.media_list.scantime = time.time()
-        self.fill_list(songdata)
-        self._updateStatus("Found %s Songs" % len(self.media_list.rows))
-        print "Done scanning."
-
-    def findInZip(self, path, songlist, curfiles, fileinfo, titlere=None):
-        #print "_searchZip %s" % path
-        zip = zipfile.ZipFile(path)
-        origfile = os.path.basename(path)
-        namelist = zip.namelist()
-        for filename in namelist:
-            filepath = os.path.join(path, filename)
-            if filename in curfiles:
-                #print "Already have entry for: %s" % filename
+        # See if we have a title_re file
+        if 'titlere.txt' in names:
+            print "Found titlere.txt"
+            title_res = []
+            f = open(os.path.join(root, 'titlere.txt'))
+            try:
+                redata = f.readlines()
+            finally:
+                f.close()
+            for titlere in redata:
+                title_res.append(re.compile(titlere.strip()))
+        return title_res
+
+    def checkFiles(self, root, names, checks, known, archives, seen, jobs,
+                   fileinfo, title_res, force=False):
+        """checkFiles   Looks at the songs and zip archives among
+        checks, in the directory root whose files are names, and adds
+        a job to jobs for each that is new or has changed, or for
+        every one if force is set."""
+        # The sound files here, to pair with the CDG files.
+        musicfiles = eo_meta.getMusicFiles(names)
+
+        for file in checks:
+            name, ext = os.path.splitext(file)
+            if ext not in self.kar_exts and ext != '.zip':
+                continue
+            filepath = os.path.join(root, file)
+            try:
+                st = os.stat(filepath)
+            except OSError:
+                continue
+            fingerprint = self.getFingerprint(st)
+            key = (filepath, '')
+            if key in seen and not (seen[key] and force):
+                # Already looked at, when several of the paths
+                # scanned lead to it.
                 continue
 
-            root, ext = os.path.splitext(filename)
             if ext in self.kar_exts:
-                # Python zipfile only supports deflated and stored
-                info = zip.getinfo(filename)
-                if info.compress_type == zipfile.ZIP_STORED \
-                or info.compress_type == zipfile.ZIP_DEFLATED:
-                    completefn = os.path.join(
-                        origfile,
-                        filename
-                    )
-                    artist, title, genre = self.getFileInfo(
-                            completefn,
-                            fileinfo,
-                            titlere
-                    )
-                    #print "ZIP FILENAME: %s" % completefn
-                    print "Adding %s" % filename
-                    self._updateStatus("Adding %s by %s" % (title, artist))
-                    songlist.append([
-                        artist,
-                        title,
-                        genre,
-                        '.zip',
-                        #completefn
-                        filename,
-                        path
-                    ])
+                # A song must be read again if its sound file has
+                # changed, gone or turned up too.
+                sound = None
+                if name in musicfiles:
+                    soundpath = os.path.join(root, musicfiles[name])
+                    try:
+                        sound = (soundpath,
+                                 self.getFingerprint(os.stat(soundpath)))
+                    except OSError:
+                        pass
+                seen[key] = self.isIndexed(key, (fingerprint, sound),
+                                           known) and not force
+                if not seen[key] and sound:
+                    jobs.append(('file', filepath, soundpath,
+                                 self.getTitleInfo([file], fileinfo),
+                                 title_res))
+            elif ext == '.zip':
+                members = archives.get(filepath, [])
+                old = self.libindex.get(key)
+                self.libindex[key] = fingerprint
+                # Archives listed before there was an index are
+                # taken as they are, if they have any songs.
+                seen[key] = (old == fingerprint or (old is None and members)) \
+                            and not force
+                if seen[key]:
+                    for member in members:
+                        seen[member] = True
                 else:
-                    print "ZIP member %s compressed with unsupported type (%d)" % (
-                        filename, info.compress_type
+                    self.findInZip(
+                        filepath,
+                        fingerprint,
+                        jobs,
+                        known,
+                        seen,
+                        fileinfo,
+                        title_res,
+                        force
                     )
 
+    def findInZip(self, path, fingerprint, jobs, known, seen, fileinfo,
+                  titlere=None, force=False):
+        """findInZip   Adds a job to jobs for the songs in the zip
+        archive at path that are new or have changed, or for all of
+        them if force is set.  fingerprint is the archive's (size,
+        mtime), for the listing cache."""
+        #print "_searchZip %s" % path
+        listing = self.getZipListing(path, fingerprint)
+        if listing is None:
+            return
+        fingerprints = dict((entry[0], (entry[1], entry[2]))
+                            for entry in listing)
+        members = []
+        for filename, size, crc, compress_type in listing:
+            root, ext = os.path.splitext(filename)
+            if ext in self.kar_exts:
+                key = (filename, path)
+                sound = eo_meta.getZipSoundFile(filename, fingerprints)
+                if sound:
+                    sound = (sound, fingerprints[sound])
+                seen[key] = self.isIndexed(key, ((size, crc), sound), known) \
+                            and not force
+                if seen[key]:
+                    #print "Already have entry for: %s" % filename
+                    continue
+                members.append(filename)
+
+        if members:
+            jobs.append(('zip', path, members, listing,
+                         self.getTitleInfo(members, fileinfo), titlere))
+
+    def getTitleInfo(self, files, fileinfo):
+        """getTitleInfo   Returns the part of fileinfo (from the
+        titles.txt files) that applies to files, to send with a job."""
+        info = {}
+        for file in files:
+            basename = os.path.basename(file)
+            if basename in fileinfo:
+                info[basename] = fileinfo[basename]
+        return info
+
     def OnButton_choose_btn(self, evt):
         path = self.file_tree.GetPath()
         if os.path.isfile(path):
@@ -816,14 +1135,13 @@ class EmptyOrch(wx.App, eo_web.MyTCPServer):
         else:
             self.findKaraoke(path)
     
-    def fill_list(self, data):
-        headers = ['Artist', 'Title', 'Genre', 'Type', 'Path', 'Archive']
-        self.media_list.SetData(headers, data)
-        self.media_list.SaveData(self.songdb_path)
-
 if __name__ == "__main__":
+    # The player process must be started before there are any other
+    # threads, and the frozen Windows build must run it.
+    multiprocessing.freeze_support()
     print "DATADIR:", DATADIR
-    app = EmptyOrch(False)
+    player = eo_playerproc.PlayerProcess()
+    app = EmptyOrch(player, False)
 
     #print "MediaList:", app.media_list.rows
     print "---------------------"
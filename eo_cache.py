@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+import os
+import hashlib
+import threading
+
+# The default size budget of the cache, in megabytes.
+DEFAULT_CACHE_SIZE = 512
+
+class ZipCache:
+    """ZipCache   An on-disk cache of members extracted from zip
+    archives, so that a song sung again does not have to be inflated
+    again.
+
+    Members are keyed by the archive's path and modification time
+    and the member's name, so a changed archive is extracted afresh.
+    When the cached files come to more than maxSize bytes the least
+    recently used ones are removed.  It may be used from several
+    threads at once."""
+
+    def __init__(self, cachedir, maxSize=DEFAULT_CACHE_SIZE * 1024 * 1024):
+        self.cachedir = cachedir
+        self.maxSize = maxSize
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+
+        # Cached file name -> (last use, size).  The last use is kept
+        # as the file's modification time, so that it survives from
+        # one run to the next.
+        self.entries = {}
+        self.size = 0
+        for name in os.listdir(cachedir):
+            path = os.path.join(cachedir, name)
+            if name.endswith('.tmp'):
+                # Left over from a run that was killed mid-write.
+                os.remove(path)
+                continue
+            st = os.stat(path)
+            self.entries[name] = (st.st_mtime, st.st_size)
+            self.size += st.st_size
+        self._evict()
+
+    def _name(self, zippath, member):
+        zippath = os.path.abspath(zippath)
+        mtime = int(os.stat(zippath).st_mtime)
+        key = hashlib.sha1("%s\0%d\0%s" % (zippath, mtime, member)).hexdigest()
+        # Keep the extension, for the benefit of the mixer.
+        return key + os.path.splitext(member)[1].lower()
+
+    def Get(self, zippath, member):
+        """Get   Returns the path of the cached copy of the member, or
+        None if it is not cached."""
+        name = self._name(zippath, member)
+        self.lock.acquire()
+        try:
+            if name not in self.entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            path = os.path.join(self.cachedir, name)
+            try:
+                os.utime(path, None)
+            except OSError:
+                # Removed behind our back.
+                self.size -= self.entries.pop(name)[1]
+                self.hits -= 1
+                self.misses += 1
+                return None
+            self.entries[name] = (os.stat(path).st_mtime, self.entries[name][1])
+            return path
+        finally:
+            self.lock.release()
+
+    def Put(self, zippath, member, data):
+        """Put   Stores the member's data in the cache and returns the
+        path of the cached copy, or None if it is too big to cache."""
+        if len(data) > self.maxSize:
+            return None
+        name = self._name(zippath, member)
+        path = os.path.join(self.cachedir, name)
+
+        # Write under a temporary name, so that a half-written file is
+        # never taken for a cached one.
+        temppath = "%s.%d.tmp" % (path, threading.currentThread().ident)
+        f = open(temppath, 'wb')
+        try:
+            f.write(data)
+        finally:
+            f.close()
+
+        self.lock.acquire()
+        try:
+            if name in self.entries:
+                self.size -= self.entries.pop(name)[1]
+                if os.name == 'nt':
+                    # rename() will not replace a file here.
+                    os.remove(path)
+            os.rename(temppath, path)
+            self.entries[name] = (os.stat(path).st_mtime, len(data))
+            self.size += len(data)
+            self._evict(keep=name)
+        finally:
+            self.lock.release()
+        return path
+
+    def _evict(self, keep=None):
+        """_evict   Removes the least recently used files until the
+        cache is within its budget.  Must be called with the lock
+        held, or before the cache is shared."""
+        if self.size <= self.maxSize:
+            return
+        lru = [(used, name) for name, (used, size) in self.entries.items()
+               if name != keep]
+        lru.sort()
+        for used, name in lru:
+            if self.size <= self.maxSize:
+                break
+            try:
+                os.remove(os.path.join(self.cachedir, name))
+            except OSError:
+                # Most likely still open by the mixer on Windows; it
+                # goes next time.
+                continue
+            self.size -= self.entries.pop(name)[1]
+
+    def GetStats(self):
+        """GetStats   Returns (hits, misses, bytes cached)."""
+        return (self.hits, self.misses, self.size)
@@ -0,0 +1,331 @@
+#!/usr/bin/env python
+
+import os
+import wave
+import zipfile
+import cStringIO
+import multiprocessing
+
+from mutagen.mp3 import MP3
+from mutagen.oggvorbis import OggVorbis
+from mutagen.easyid3 import EasyID3
+from mutagen.id3 import ID3NoHeaderError
+
+from pycdg import cdgSong
+
+KAR_EXTS = ('.cdg', '.kar')
+# The sound files that go with a CDG file are the ones cdgSong plays.
+SOUND_EXTS = tuple(cdgSong.validexts)
+MEDIA_EXTS = SOUND_EXTS + ('.avi', '.mpg')
+
+# How much of a sound file in a zip archive is inflated to find its
+# audio properties at scan time; the rest are found at play time.
+AUDIO_HEADER_SIZE = 64 * 1024
+
+# How many songs the scanner hands a process at a time.
+SCAN_CHUNK = 16
+
+def getFileInfoFromMeta(musicfile):
+    artist = ''
+    title = ''
+    genre = ''
+
+    if musicfile:
+        name, ext = os.path.splitext(musicfile)
+        print "Name:", name
+        print "Ext:", ext
+        if ext == '.mp3':
+            print "MP3"
+            try:
+                eid = EasyID3(musicfile)
+                artist = eid.get('artist', [''])[0]
+                title = eid.get('title', [''])[0]
+                genre = eid.get('genre', ['karaoke'])[0]
+                print "Got: (%s, %s, %s)" % (artist, title, genre)
+            except ID3NoHeaderError:
+                print "No ID Header for", musicfile
+        elif ext == '.ogg':
+            audio = OggVorbis(musicfile)
+            artist = audio.get('artist', '')[0]
+            title = audio.get('title', '')[0]
+            genre = audio.get('genre', ['karaoke'])[0]
+
+    return artist, title, genre
+
+def getFileInfoFromRegex(file, titleres=None):
+    #print "getFileInfoRegex: %s" % file
+    artist0, title0 = ('','')
+
+    if (not artist0 or not title0) and titleres:
+        for titlere in titleres:
+            results = titlere.match(file) 
+            print "Finding RE: %s for %s" % (results, file)
+            if results:
+                resdict = results.groupdict()
+                artist0 = resdict.get('artist', '')
+                title0 = resdict.get('title', '')
+                print "RE results %s, %s" % (artist0, title0)
+                break
+
+    return artist0, title0
+
+def getFileInfoFromGuess(file):
+    #print "getFileInfoFromGuess: %s " % file
+    filebase = os.path.basename(file)
+    title = ""
+    artist = ""
+
+    chunks = filebase.split(" - ")
+    if len(chunks) >= 2:
+        title = chunks[-1].split(".")[0].strip()
+        artist = chunks[-2].strip()
+        #print "' - 'artist:%s, title:%s: " % (artist, title)
+
+    if not title and not artist:
+        chunks = filebase.split("-")
+        if len(chunks) >= 2:
+            title = chunks[-1].split(".")[0].strip()
+            artist = chunks[-2].strip()
+            #print "'-'artist:%s, title:%s: " % (artist, title)
+
+    if not title and not artist:
+        chunks = filebase.split("-")
+        if len(chunks) >= 2:
+            title = chunks[-1].split(".")[0].strip()
+            artist = chunks[-1].strip()
+            #print "' 'artist:%s, title:%s: " % (artist, title)
+
+    return artist, title
+
+def getFileInfoFromInfo(filepath, fileinfo):
+    #print "getFileInfoFromInfo: ",
+    basename = os.path.basename(filepath)
+    title, artist = fileinfo.get(basename, ('', ''))
+    return artist, title
+
+def getFileInfo(filepath, fileinfo, titlere, musicfile=None):
+    genre = ''
+    print "Get File Info from Info"
+    artist, title = getFileInfoFromInfo(filepath, fileinfo)
+    if not artist or not title:
+        print "Nope.  Get Info From Meta"
+        artist, title, genre = getFileInfoFromMeta(musicfile)
+    if not artist or not title and titlere:
+        print "Nope.  Get Info From Regex"
+        artist, title = getFileInfoFromRegex(filepath, titlere)
+    if not artist or not title:
+        print "Nope.  Get Info From Guess"
+        artist, title = getFileInfoFromGuess(filepath)
+    return artist, title, genre
+
+class HeaderFile:
+    """HeaderFile   A read-only file holding the start (data) of a
+    file of size bytes, so that its length can be worked out from its
+    header without reading the rest.  Reads past the start return
+    nothing."""
+    def __init__(self, data, size):
+        self.data = data
+        self.size = max(size, len(data))
+        self.pos = 0
+
+    def read(self, n=-1):
+        if n < 0:
+            n = self.size - self.pos
+        data = self.data[self.pos:self.pos + n]
+        self.pos = min(self.pos + n, self.size)
+        return data
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            offset += self.size
+        self.pos = max(0, min(offset, self.size))
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        pass
+
+def getAudioInfo(musicfile, data=None, size=None):
+    """getAudioInfo   Returns the (sample rate, channels, length in
+    seconds) of a sound file, or None if they cannot be found.  If
+    data is given it is the contents of the file, which is named
+    by musicfile (say, a member of a zip); if size is given too, data
+    is only the start of a file of that size."""
+    ext = os.path.splitext(musicfile)[1].lower()
+    f = musicfile
+    if data is not None and size is not None:
+        f = HeaderFile(data, size)
+    elif data is not None:
+        f = cStringIO.StringIO(data)
+    try:
+        if ext == '.mp3':
+            info = MP3(f).info
+            return (info.sample_rate, info.channels, info.length)
+        elif ext == '.ogg':
+            info = OggVorbis(f).info
+            return (info.sample_rate, info.channels, info.length)
+        elif ext == '.wav':
+            w = wave.open(f)
+            try:
+                return (w.getframerate(), w.getnchannels(),
+                        w.getnframes() / float(w.getframerate()))
+            finally:
+                w.close()
+    except Exception, e:
+        print "No audio info for %s: %s" % (musicfile, e)
+    return None
+
+def getMusicFiles(files):
+    """getMusicFiles   Returns the sound files among files (the names
+    in a directory), by their names without the extension, so that the
+    one for a CDG file can be looked up without listing the directory
+    again.  If there are several for a name, the first is taken."""
+    musicfiles = {}
+    for file in files:
+        name, ext = os.path.splitext(file)
+        if ext.lower() in SOUND_EXTS and name not in musicfiles:
+            musicfiles[name] = file
+    return musicfiles
+
+def getZipListing(path):
+    """getZipListing   Returns the directory of the zip archive at
+    path: a list of (name, size, CRC, compression type) for each
+    member, in the archive's order, or None if it is not a zip
+    archive."""
+    try:
+        zip = zipfile.ZipFile(path)
+    except (zipfile.BadZipfile, IOError):
+        return None
+    try:
+        return [(info.filename, info.file_size, info.CRC, info.compress_type)
+                for info in zip.infolist()]
+    finally:
+        zip.close()
+
+def getZipSoundFile(filename, names):
+    """getZipSoundFile   Returns the member of a zip archive (whose
+    members are names) that is the sound file for filename, as
+    cdgSong finds it, or None if there is none."""
+    root = os.path.splitext(filename)[0]
+    for ext in SOUND_EXTS:
+        if root + ext in names:
+            return root + ext
+    return None
+
+def getZipAudioInfo(zip, filename, sizes):
+    """getZipAudioInfo   Returns the audio properties of the sound
+    file that goes with filename in the zip, as cdgSong finds it;
+    sizes holds the size of each member.  Only the first
+    AUDIO_HEADER_SIZE bytes are inflated, so formats whose length is
+    not in the header (Ogg) are left to be found at play time."""
+    soundfile = getZipSoundFile(filename, sizes)
+    if soundfile is None:
+        return None
+    f = zip.open(soundfile)
+    try:
+        data = f.read(min(sizes[soundfile], AUDIO_HEADER_SIZE))
+    finally:
+        f.close()
+    return getAudioInfo(soundfile, data, sizes[soundfile])
+
+def readSong(job):
+    """readSong   Reads the tags and audio properties of the songs a
+    scan found, in a scanner process.  job is ('file', path, sound
+    file path, fileinfo, titleres) for a song on its own, or ('zip',
+    path, members, listing, fileinfo, titleres) for songs in a zip
+    archive, whose directory is listing (see getZipListing).
+    Returns a list of (song list row, audio properties)."""
+    try:
+        if job[0] == 'file':
+            return readFileSong(*job[1:])
+        else:
+            return readZipSongs(*job[1:])
+    except Exception, e:
+        # One bad file should not stop the scan.
+        print "Cannot read %s: %s" % (job[1], e)
+        return []
+
+def readFileSong(filepath, musicfile, fileinfo, titlere=None):
+    name, ext = os.path.splitext(musicfile)
+    artist, title, genre = getFileInfo(
+            filepath,
+            fileinfo,
+            titlere,
+            musicfile
+    )
+    return [([artist, title, genre, ext, filepath, ''],
+             getAudioInfo(musicfile))]
+
+def readZipSongs(path, members, listing, fileinfo, titlere=None):
+    songs = []
+    sizes = dict((entry[0], entry[1]) for entry in listing)
+    compress_types = dict((entry[0], entry[3]) for entry in listing)
+    zip = zipfile.ZipFile(path)
+    try:
+        origfile = os.path.basename(path)
+        for filename in members:
+            # Python zipfile only supports deflated and stored
+            compress_type = compress_types[filename]
+            if compress_type == zipfile.ZIP_STORED \
+            or compress_type == zipfile.ZIP_DEFLATED:
+                completefn = os.path.join(
+                    origfile,
+                    filename
+                )
+                artist, title, genre = getFileInfo(
+                        completefn,
+                        fileinfo,
+                        titlere
+                )
+                #print "ZIP FILENAME: %s" % completefn
+                songs.append(([
+                    artist,
+                    title,
+                    genre,
+                    '.zip',
+                    #completefn
+                    filename,
+                    path
+                ], getZipAudioInfo(zip, filename, sizes)))
+            else:
+                print "ZIP member %s compressed with unsupported type (%d)" % (
+                    filename, compress_type
+                )
+    finally:
+        zip.close()
+    return songs
+
+class ScanPool:
+    """ScanPool   The scanner processes, procs of them (one per CPU
+    if procs is 0), which read the songs for every scan.  With procs
+    of 1 it is all done in this process.
+
+    The processes are started here, once, so make it before the
+    wx.App, while this process has only the one thread."""
+
+    def __init__(self, procs=0):
+        if not procs:
+            procs = multiprocessing.cpu_count()
+        self.pool = None
+        if procs > 1:
+            self.pool = multiprocessing.Pool(procs)
+
+    def ReadSongs(self, jobs):
+        """ReadSongs   Runs readSong() over jobs, yielding the
+        results in the order of the jobs."""
+        if not self.pool or len(jobs) < 2:
+            for job in jobs:
+                yield readSong(job)
+            return
+        for result in self.pool.imap(readSong, jobs, SCAN_CHUNK):
+            yield result
+
+    def Close(self):
+        """Close   Stops the scanner processes."""
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
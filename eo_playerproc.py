@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+
+import os
+import time
+import threading
+import multiprocessing
+
+import pygame
+
+import eo_cache
+from pycdg import cdgPlayer, cdgSong, closeSession, PLAYER_IDLE_WAIT
+from pykconstants import *
+
+DATADIR = os.path.dirname(os.path.abspath(__file__))
+if os.path.basename(DATADIR) == "library.zip":
+    # If we are using a frozen package set the DATADIR
+    DATADIR = os.path.dirname(DATADIR)
+
+# How often (in milliseconds) the player process reports its state.
+STATUS_INTERVAL = 100
+
+
+class cdgAppPlayer(cdgPlayer):
+    """cdgAppPlayer Override for NT specific issues"""
+    # Keep the window and audio device open from one song to the next.
+    keepSession = True
+
+    def shutdown(self):
+        """ shutdown Override shutdown for NT"""
+        if os.name == 'nt' and pygame.mixer.get_init():
+            # Must load another mp3 for pygame since it never wants to
+            # release the file and we want to cleanup the temp dir.
+            pygame.mixer.music.load(os.path.join(DATADIR, 'fake.mp3'))
+
+        cdgPlayer.shutdown(self)
+
+
+class PlayerProcess:
+    """PlayerProcess   Runs the CDG player in a process of its own, so
+    that the GUI, the web server and the scanner cannot hold up the
+    lyrics, and controls it from here.
+
+    Commands are sent down a pipe and return at once.  The player
+    process sends back its state every STATUS_INTERVAL milliseconds,
+    and tells us when a song finishes, is closed or fails; call Poll()
+    from time to time to read these.
+
+    Start it before the wx.App is made, while this process has only
+    the one thread, and call multiprocessing.freeze_support() first
+    in a frozen build.  The attributes State, displaySize,
+    fullScreen and InternalOffsetTime are those last reported for the
+    current song, or the last one.
+
+    Each Load() and shutdown() is numbered, and the player process
+    tags what it sends with the number of the one it is acting on,
+    so that Poll() can drop what it said about a song since stopped:
+    a song that finishes just as another is started by hand must not
+    move the playlist on."""
+
+    def __init__(self, cachedir=None, cacheSize=None):
+        self.conn, childConn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            target=runPlayerProcess,
+            args=(childConn, cachedir, cacheSize)
+        )
+        self.process.daemon = True
+        self.process.start()
+
+        self.State = STATE_CLOSED
+        self.displaySize = None
+        self.fullScreen = None
+        self.InternalOffsetTime = None
+        self.pos = 0
+        self.length = None
+        self.statusTime = time.time()
+        self.seq = 0
+
+    def _send(self, *command):
+        try:
+            self.conn.send(command)
+        except (IOError, EOFError):
+            print "Player process has gone away."
+
+    def Load(self, cdgfile, **kwds):
+        """Load   Stops the current song and loads another; the
+        keywords are passed on to cdgPlayer."""
+        self.seq += 1
+        self.State = STATE_INIT
+        self._send('load', self.seq, cdgfile, kwds)
+
+    def SetCache(self, cachedir, cacheSize):
+        """SetCache   Keeps the sound files of songs in zip archives
+        in cachedir, up to cacheSize bytes (see eo_cache)."""
+        self._send('cache', cachedir, cacheSize)
+
+    def Prefetch(self, cdgfile, zippath=None):
+        """Prefetch   Starts loading the song that is likely to be
+        played next (see cdgSong)."""
+        self._send('prefetch', cdgfile, zippath)
+
+    def Play(self):
+        self._send('play')
+
+    def Pause(self):
+        self._send('pause')
+
+    def Seek(self, pos):
+        self._send('seek', pos)
+
+    def shutdown(self):
+        """shutdown   Stops the current song."""
+        self.seq += 1
+        self._send('stop', self.seq)
+
+    def Close(self):
+        """Close   Stops the player process."""
+        self._send('quit')
+        self.process.join()
+
+    def Poll(self):
+        """Poll   Reads what the player process has sent since the
+        last call, and returns the list of events: ('finished',) when
+        a song has played to the end, ('closed',) when it was closed
+        from the player window, and ('error', message) when it could
+        not be played.  Events about songs before the last Load() or
+        shutdown() are left out."""
+        events = []
+        try:
+            while self.conn.poll():
+                message = self.conn.recv()
+                name, seq, args = message[0], message[1], message[2:]
+                if name == 'status':
+                    (state, pos, length, displaySize,
+                     fullScreen, offsetTime) = args
+                    # Between songs there are no settings to report;
+                    # keep the last song's, even if it has since been
+                    # stopped.
+                    if displaySize:
+                        self.displaySize = displaySize
+                        self.fullScreen = fullScreen
+                        self.InternalOffsetTime = offsetTime
+                    if seq == self.seq:
+                        self.State, self.pos, self.length = state, pos, length
+                        self.statusTime = time.time()
+                elif seq == self.seq:
+                    events.append((name,) + args)
+        except (IOError, EOFError):
+            print "Player process has gone away."
+            self.State = STATE_CLOSED
+        return events
+
+    def GetPos(self):
+        """GetPos   Returns the position in the current song (in
+        milliseconds), as of the last report plus the time since."""
+        if self.State == STATE_PLAYING:
+            return self.pos + int((time.time() - self.statusTime) * 1000)
+        return self.pos
+
+    def GetLength(self):
+        return self.length
+
+
+class PlayerServer:
+    """PlayerServer   The player process's side of PlayerProcess."""
+
+    def __init__(self, conn, cachedir=None, cacheSize=None):
+        self.conn = conn
+        self.player = None
+        self.prefetched = None
+        self.prefetchthread = None
+        self.quit = False
+        self.statusTime = 0
+        # The number of the last load or stop (see PlayerProcess).
+        self.seq = 0
+        if cachedir:
+            cdgAppPlayer.zipCache = eo_cache.ZipCache(cachedir, cacheSize)
+
+    def Run(self):
+        while not self.quit:
+            if self.player:
+                self.player.handleEvents()
+                self.player.doStuff()
+                if self.player.State == STATE_CLOSED:
+                    # It stopped by itself, at the end of the song or
+                    # from the window.
+                    finished = self.player.songFinished
+                    self.player = None
+                    self.sendStatus()
+                    if finished:
+                        self.conn.send(('finished', self.seq))
+                    else:
+                        self.conn.send(('closed', self.seq))
+            elif pygame.display.get_init():
+                # Keep the window responsive between songs, and
+                # don't let the next song see stale key presses.
+                pygame.event.get()
+
+            if (time.time() - self.statusTime) * 1000 >= STATUS_INTERVAL:
+                self.sendStatus()
+
+            waitTime = PLAYER_IDLE_WAIT
+            if self.player:
+                waitTime = self.player.GetWaitTime()
+            if self.conn.poll(waitTime / 1000.0):
+                while not self.quit and self.conn.poll():
+                    self.handleCommand(self.conn.recv())
+
+        self.stop()
+        if self.prefetchthread:
+            self.prefetchthread.join()
+        closeSession()
+        if cdgAppPlayer.zipCache:
+            print "Zip cache: %d hits, %d misses, %d bytes" % cdgAppPlayer.zipCache.GetStats()
+
+    def sendStatus(self):
+        self.statusTime = time.time()
+        if self.player:
+            player = self.player
+            self.conn.send(('status', self.seq, player.State,
+                            player.GetPos(), player.GetLength(),
+                            player.displaySize, player.fullScreen,
+                            player.InternalOffsetTime))
+        else:
+            self.conn.send(('status', self.seq, STATE_CLOSED, 0, None,
+                            None, None, None))
+
+    def errorNotify(self, ErrorString):
+        print ErrorString
+        self.conn.send(('error', self.seq, ErrorString))
+
+    def handleCommand(self, command):
+        name, args = command[0], command[1:]
+        if name == 'load' or name == 'stop':
+            self.seq, args = args[0], args[1:]
+
+        if name == 'load':
+            self.load(*args)
+        elif name == 'prefetch':
+            self.prefetch(*args)
+        elif name == 'cache':
+            cdgAppPlayer.zipCache = eo_cache.ZipCache(*args)
+        elif name == 'quit':
+            self.quit = True
+        elif not self.player:
+            pass
+        elif name == 'play':
+            self.player.Play()
+        elif name == 'pause':
+            self.player.Pause()
+        elif name == 'seek':
+            self.player.Seek(*args)
+        elif name == 'stop':
+            self.stop()
+        self.sendStatus()
+
+    def stop(self):
+        if self.player:
+            self.player.shutdown()
+            self.player = None
+
+    def load(self, cdgfile, kwds):
+        self.stop()
+
+        # Use the prefetched song, if this is it.
+        song = None
+        if self.prefetched and self.prefetched.Matches(cdgfile, kwds.get('zippath')):
+            self.prefetchthread.join()
+            self.prefetchthread = None
+            song = self.prefetched
+            self.prefetched = None
+
+        try:
+            self.player = cdgAppPlayer(
+                cdgfile,
+                errorNotifyCallback = self.errorNotify,
+                song = song,
+                **kwds
+            )
+        except:
+            # The player has already said why, if it could.
+            self.player = None
+            self.conn.send(('error', self.seq, "Cannot play %s" % cdgfile))
+
+    def prefetch(self, cdgfile, zippath):
+        if self.prefetched and self.prefetched.Matches(cdgfile, zippath):
+            return
+        if self.prefetchthread and self.prefetchthread.isAlive():
+            # Don't hold up the song; the GUI asks again.
+            return
+        if self.prefetched:
+            self.prefetched.Cleanup()
+
+        print "Prefetching", cdgfile
+        self.prefetched = cdgSong(cdgfile, zippath, cache=cdgAppPlayer.zipCache)
+        self.prefetchthread = threading.Thread(target=self.prefetched.Prefetch)
+        self.prefetchthread.start()
+
+
+def runPlayerProcess(conn, cachedir=None, cacheSize=None):
+    """runPlayerProcess   The body of the player process."""
+    PlayerServer(conn, cachedir, cacheSize).Run()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+import os
+import time
+import threading
+
+import eo_meta
+
+try:
+    import pyinotify
+except ImportError:
+    # Watching is only available on Linux, with pyinotify.
+    pyinotify = None
+
+# How long (in seconds) the files must be left alone before a batch
+# of changes is passed on, so that a song being copied in is read
+# once, when it is complete.
+WATCH_SETTLE = 2.0
+
+# The files that can change the song list.
+WATCH_EXTS = eo_meta.KAR_EXTS + eo_meta.MEDIA_EXTS + ('.zip',)
+WATCH_FILES = ['titles.txt', 'titlere.txt']
+
+
+def isAvailable():
+    """isAvailable   Returns True if the library can be watched here."""
+    return pyinotify is not None
+
+
+class LibraryWatcher:
+    """LibraryWatcher   Watches the scan directories for songs,
+    sound files and zip archives that are created, written, moved or
+    deleted, and the directories they are in, and calls
+    callback(paths) with the paths that have changed.
+
+    Changes are gathered until there have been none for WATCH_SETTLE
+    seconds, and passed on in one call from a thread of the watcher's
+    own; the callback need not be quick, as changes that come in the
+    meantime are kept for the next call."""
+
+    def __init__(self, dirs, callback):
+        self.dirs = [d for d in dirs if os.path.isdir(d)]
+        self.callback = callback
+        self.pending = {}
+        self.lastChange = 0
+        self.quit = False
+        self.cond = threading.Condition()
+
+        self.manager = pyinotify.WatchManager()
+        self.notifier = pyinotify.ThreadedNotifier(
+            self.manager,
+            _EventHandler(watcher=self)
+        )
+        self.notifier.daemon = True
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+
+    def Start(self):
+        self.notifier.start()
+        mask = (pyinotify.IN_CREATE | pyinotify.IN_CLOSE_WRITE |
+                pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO |
+                pyinotify.IN_DELETE)
+        for d in self.dirs:
+            print "Watching: %s" % d
+            self.manager.add_watch(d, mask, rec=True, auto_add=True)
+        self.thread.start()
+
+    def Stop(self):
+        self.cond.acquire()
+        try:
+            self.quit = True
+            self.cond.notify()
+        finally:
+            self.cond.release()
+        self.notifier.stop()
+        self.thread.join()
+
+    def Changed(self, path, isdir=False):
+        """Changed   Notes that the file or directory at path has
+        changed, if it can make a difference to the song list."""
+        name = os.path.basename(path)
+        if not isdir and name not in WATCH_FILES and \
+           os.path.splitext(name)[1] not in WATCH_EXTS:
+            return
+        self.cond.acquire()
+        try:
+            self.pending[path] = True
+            self.lastChange = time.time()
+            self.cond.notify()
+        finally:
+            self.cond.release()
+
+    def _run(self):
+        while True:
+            self.cond.acquire()
+            try:
+                while not self.quit:
+                    if self.pending:
+                        wait = self.lastChange + WATCH_SETTLE - time.time()
+                        if wait <= 0:
+                            break
+                        self.cond.wait(wait)
+                    else:
+                        self.cond.wait()
+                if self.quit:
+                    return
+                paths = sorted(self.pending.keys())
+                self.pending = {}
+            finally:
+                self.cond.release()
+            try:
+                self.callback(paths)
+            except Exception, e:
+                print "Cannot update the song list: %s" % e
+
+
+if pyinotify is not None:
+    class _EventHandler(pyinotify.ProcessEvent):
+        def my_init(self, watcher):
+            self.watcher = watcher
+
+        def process_default(self, event):
+            if event.mask & pyinotify.IN_Q_OVERFLOW:
+                # Some changes have been lost; look at everything.
+                for d in self.watcher.dirs:
+                    self.watcher.Changed(d, True)
+                return
+            # A file is not worth reading until it has been written
+            # and closed; a directory may be moved in full.
+            if event.mask & pyinotify.IN_CREATE and not event.dir:
+                return
+            self.watcher.Changed(event.pathname, event.dir)
@@ -26,7 +26,9 @@ class SortVirtList(
     headers = []
     rows = []
     itemDataMap = {}
+    itemIndexMap = []
     scantime = 0
+    searching = False
 
     def __init__(self):
         print "SortVirtList Init"
@@ -70,8 +72,10 @@ class SortVirtList(
         self.itemDataMap = searchData
         self.itemIndexMap = self.itemDataMap.keys()
         self.SetItemCount(len(self.itemDataMap))
+        self.searching = True
 
     def ClearSearch(self):
+        self.searching = False
         self.itemDataMap = {}
 
         for i in range(0, len(self.rows)):
@@ -139,6 +143,29 @@ class SortVirtList(
         self.SetItemCount(len(self.itemDataMap))
         self.estimateLens()
 
+    def UpdateData(self, rows, removed):
+        """UpdateData   Adds rows to the list, and takes away the rows
+        for which removed(row) is true, leaving the others where they
+        are.  While a search is shown the new rows are left out of it
+        until it is cleared."""
+        self.rows = [row for row in self.rows if not removed(row)] + rows
+        dataMap = {}
+        for index, row in self.itemDataMap.items():
+            if not removed(row):
+                dataMap[index] = row
+        indexMap = [index for index in self.itemIndexMap
+                    if index in dataMap]
+        if not self.searching:
+            next = max(dataMap.keys() or [-1]) + 1
+            for row in rows:
+                dataMap[next] = row
+                indexMap.append(next)
+                next += 1
+        self.itemDataMap = dataMap
+        self.itemIndexMap = indexMap
+        self.SetItemCount(len(self.itemDataMap))
+        self.Refresh()
+
     def SaveData(self, filename):
         print "Saving %s" % filename
         print "SCANTIME:", self.scantime
@@ -473,7 +500,25 @@ class Playlist_list(gizmos.EditableListBox):
         data = playlistCtrl.GetItem(index).GetText()
         print "Got: ", data
         return data.split("  |  ")
-    
+
+    def getNext(self):
+        """ Returns the entry selectNext() would select, without
+        selecting it, or None if there is none. """
+        index = -1
+        playlistCtrl = self.GetListCtrl()
+        numItems = playlistCtrl.GetItemCount()
+        if not numItems:
+            return None
+        index = playlistCtrl.GetNextItem(
+            index,
+            state=wx.LIST_STATE_SELECTED
+        )
+        next = (index + 1) % numItems
+        data = playlistCtrl.GetItem(next).GetText()
+        if not data:
+            return None
+        return data.split("  |  ")
+
     def selectNext(self):
         index = -1
         playlistCtrl = self.GetListCtrl()
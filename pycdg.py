@@ -64,6 +64,9 @@
 #
 # The class also exports Close(), Pause(), Rewind(), GetPos().
 #
+# Capture() renders the song to a file of video frames instead of the
+# screen, as fast as it can (see cdgexport.py).
+#
 # There are two optional parameters to the initialiser, errorNotifyCallback
 # and doneCallback:
 #
@@ -114,6 +117,13 @@
 # least every 100 milliseconds or so to guarantee good video and audio
 # response time.
 #
+# Alternatively, WaitForPlayer() runs the player until the song is
+# closed.  Between polls it sleeps until the next screen update is
+# due (GetWaitTime()), or for PLAYER_IDLE_WAIT milliseconds while the
+# song is paused or stopped, rather than spinning.  Pause(), Close()
+# and Seek() wake it up early, so they may be called from another
+# thread.
+#
 # At each call to Poll(), the player checks the current time in the
 # song. It reads the CDG file at the correct location for the current
 # position of the song, and decodes the CDG commands stored there. If
@@ -130,8 +140,9 @@
 # number of segments are likely to be changed at update time.
 #
 # NOTE: Pygame does not currently support querying the length
-# of an MP3 track, therefore the GetLength() method is not
-# currently implemented.
+# of an MP3 track, therefore GetLength() returns the length of the
+# CDG stream, unless the caller passes in the sound file's length
+# (audioProperties).
 #
 # Here follows a description of the important data stored by
 # the class:
@@ -146,6 +157,10 @@
 # need to store the pixel colours there as they are set when Scroll
 # commands are used. This stores the actual pygame colour value, not
 # indeces into our colour table.
+# In palette mode (cdgPlayer.cdgPalette) this array is not used at all:
+# tiles are filled with the colour indeces onto 8-bit surfaces, and
+# colour table changes only update the surfaces' palette; the player
+# then recolours the screen from its copy of the indeces.
 #
 # CdgPacketReader.__cdgPixelColours[300][216]
 # Store the colour index for every single pixel. The values stored
@@ -182,10 +197,12 @@ import glob
 import tempfile
 import shutil
 import zipfile
+import threading
+import cStringIO
 
 from pykconstants import *
 from pykplayer import pykPlayer 
-import sys, pygame, os, string, math, time
+import sys, pygame, os, string, math, time, struct
 from pygame.locals import *
 
 if os.name == 'nt':
@@ -202,6 +219,16 @@ try:
 except ImportError:
     aux_python = None
 
+# Numeric is only needed here to convert frames for YUV4MPEG2 dumps
+# (see cdgPlayer.Capture()).
+try:
+    import Numeric as N
+except ImportError:
+    try:
+        import numpy.oldnumeric as N
+    except ImportError:
+        N = None
+
 CDG_DISPLAY_WIDTH   = 288
 CDG_DISPLAY_HEIGHT  = 192
 
@@ -217,8 +244,485 @@ TILES_PER_COL           = 4
 TILE_WIDTH              = CDG_DISPLAY_WIDTH / TILES_PER_ROW
 TILE_HEIGHT             = CDG_DISPLAY_HEIGHT / TILES_PER_COL
 
+# In 'soft' zoom mode, dirty tiles are scaled individually together
+# with at least this many pixels of their neighbours on each side, so
+# that the smoothing filter sees the same pixels at the tile edges as
+# it would when scaling the whole screen.
+SOFT_TILE_PAD           = 2
+
+# The largest acceptable difference, in source pixels, between where
+# a tile scaled on its own and the whole screen scaled at once sample
+# the same display pixel, and how many more pixels of padding may be
+# added to get within it.
+SOFT_TILE_ERROR         = 0.02
+SOFT_TILE_SEARCH        = 32
+
+# Working out the tiles for a new display scale takes a while, so the
+# results for up to SOFT_TILE_CACHE scales are kept in softTileCache.
+# While the window is being resized, they are only worked out once
+# the size has been left alone for SOFT_TILE_DELAY milliseconds; until
+# then the whole screen is scaled.
+SOFT_TILE_CACHE         = 8
+SOFT_TILE_DELAY         = 250
+softTileCache = {}
+
+# Frame pacing.  The screen is updated frameRate times a second
+# (DEFAULT_FRAME_RATE by default), unless drawing takes more than
+# FRAME_LOAD of the time between frames, in which case the frames are
+# spaced out further, down to no fewer than MIN_FRAME_RATE a second.
+# The cost of a frame is a running average, updated by
+# FRAME_COST_SMOOTHING of the difference at each frame.
+DEFAULT_FRAME_RATE      = 30
+MIN_FRAME_RATE          = 5
+FRAME_LOAD              = 0.5
+FRAME_COST_SMOOTHING    = 0.1
+
+# Decoding ahead (cdgDecodeAhead).  The stream is decoded
+# DECODE_AHEAD_PACKETS packets at a time (a frame's worth at 30 frames
+# a second), up to DECODE_AHEAD_FRAMES runs ahead of the song.
+DECODE_AHEAD_PACKETS    = 10
+DECODE_AHEAD_FRAMES     = 8
+
+# The mixer settings: frequency, size, channels and buffer size.  The
+# frequency and channels are replaced by the sound file's own, when the
+# caller knows them (the audioProperties argument of cdgPlayer), so
+# that the mixer does not have to resample.
+MIXER_SETTINGS          = (44100, -16, 2, 4096)
+
+# The longest time (in milliseconds) WaitForPlayer() sleeps between
+# polls.  This is how quickly pygame events (key presses, window
+# resizes) are handled while the song is paused or stopped.
+PLAYER_IDLE_WAIT        = 100
+
+# The frame dump formats (see cdgPlayer.Capture()): a YUV4MPEG2 stream
+# with 4:2:0 chroma, or raw 24-bit RGB frames one after another.
+DUMP_FORMATS            = ['y4m', 'rgb']
+
+# cdgSong Class
+#
+# The files behind one song: the CDG data, the sound file to go with
+# it, and (with the Python CDG interpreter) a packet reader ready to
+# decode it.  Preparing these means reading zips, reading the whole
+# CDG file and searching for the sound file, which can take a while on
+# a slow disk or network share, so a front end can Prefetch() the next
+# song in a separate thread while the current one plays, and pass it
+# to cdgPlayer.  A song that is never played should be Cleanup()'d to
+# release its data.
+#
+# Songs in zip archives are read straight into memory: cdgFileData
+# holds the CDG member and soundFileData the sound member, which the
+# player hands to the mixer as a file object.  Only if the mixer cannot
+# play it that way is the sound member written out to a temporary
+# directory, with WriteSoundFile().  For songs on disk soundFileData is
+# None and soundFilePath names the sound file.
+#
+# If a cache is given, the members are taken from it rather than
+# inflated, and stored in it when they are not there; the sound file is
+# then played from the cached copy.  The cache must provide
+# Get(zippath, member), which returns the path of the cached copy or
+# None, and Put(zippath, member, data), which returns the path of the
+# new copy or None if it was not cached (see eo_cache.ZipCache).
+#
+# With sound set to False the sound file is not looked for at all, for
+# rendering the graphics only (see cdgPlayer.Capture()).
+class cdgSong:
+    # Sound file extensions, in the order they are looked for.
+    validexts = [
+        '.wav', '.ogg', '.mp3'
+    ]
+
+    def __init__(self, cdgfile, zippath=None, errorNotifyCallback=None,
+                 cache=None, sound=True):
+        self.cdgfile = cdgfile
+        self.zippath = zippath or None
+        self.cache = cache
+        self.sound = sound
+        self.ErrorNotifyCallback = errorNotifyCallback or defaultErrorPrint
+        # The name of the sound file, or of the sound member of the
+        # zip; soundFilePath is only set for a file on disk.
+        self.soundFileName = None
+        self.soundFilePath = None
+        self.soundFileData = None
+        self.cdgFileData = None
+        self.packetReader = None
+        self.loaded = False
+
+    def Matches(self, cdgfile, zippath=None):
+        """ Returns true if this is the song in the indicated file. """
+        return self.cdgfile == cdgfile and self.zippath == (zippath or None)
+
+    def Load(self):
+        """ Finds the sound file and reads the CDG data, unless this
+        has already been done.  Raises an exception if either file is
+        missing. """
+
+        if self.loaded:
+            return
+
+        print "Get soundFileData"
+        cdgfile = self.cdgfile
+        if self.zippath:
+            print "Opening zip, %s" % self.zippath
+            self._readZipData(cdgfile, self.zippath)
+        elif self.sound:
+            basepath = os.path.splitext(cdgfile)[0]
+            candidates = glob.glob("%s.*" % basepath)
+            for candidate in candidates:
+                name, ext = os.path.splitext(candidate)
+                if ext.lower() in self.validexts:
+                    self.soundFilePath = candidate
+                    self.soundFileName = candidate
+                    break
+
+            if not self.soundFilePath:
+                ErrorString = "There is no mp3 or ogg file to match : %s" % cdgfile
+                self.ErrorNotifyCallback (ErrorString)
+                raise IOError, ErrorString
+
+        if not self.zippath:
+            print "Get cdg file data."
+            f = open(cdgfile, 'rb')
+            try:
+                self.cdgFileData = f.read()
+            finally:
+                f.close()
+
+        # The Python interpreter can be set up in advance for drawing
+        # through a palette (see cdgPlayer.cdgPalette); all it needs is
+        # an 8-bit surface to tell it so.
+        if not aux_c:
+            tile = pygame.Surface((TILE_WIDTH, TILE_HEIGHT), 0, 8)
+            self.packetReader = aux_python.CdgPacketReader(self.cdgFileData, tile)
+
+        self.loaded = True
+
+    def Prefetch(self):
+        """ Loads the song, ignoring any errors; they are reported
+        again when the song is played.  This is intended to be the
+        target of a thread. """
+
+        try:
+            self.Load()
+        except:
+            print "Prefetch of %s failed" % self.cdgfile
+
+    def Cleanup(self):
+        """ Releases the song's data. """
+        self.soundFileData = None
+        self.cdgFileData = None
+        self.packetReader = None
+        self.loaded = False
+
+    def WriteSoundFile(self, tempdir):
+        """ Writes the sound member read from the zip to the indicated
+        directory, and returns its path there. """
+
+        soundFilePath = os.path.join(tempdir, self.soundFileName)
+        dirname = os.path.dirname(soundFilePath)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        f = open(soundFilePath, 'wb')
+        try:
+            f.write(self.soundFileData)
+        finally:
+            f.close()
+        return soundFilePath
+
+    def _readZipData(self, cdgfile, zippath):
+        basepath = os.path.splitext(cdgfile)[0]
+
+        zip = zipfile.ZipFile(zippath)
+        try:
+            namelist = zip.namelist()
+            zipSoundFile = None
+
+            if cdgfile not in namelist:
+                ErrorString = "Not cdg match in archive for %s" % cdgfile
+                self.ErrorNotifyCallback(ErrorString)
+                raise IOError, ErrorString
+
+            self.cdgFileData = self._readZipMember(zip, zippath, cdgfile)
+            if not self.sound:
+                return
+
+            for ext in self.validexts:
+                tempsound = "%s%s" % (basepath, ext)
+                if tempsound in namelist:
+                    zipSoundFile = tempsound
+                    break
+            if not zipSoundFile:
+                ErrorString = "There is no mp3 or ogg file to match : %s" % cdgfile
+                self.ErrorNotifyCallback (ErrorString)
+                raise IOError, ErrorString
+
+            self.soundFileName = zipSoundFile
+            if self.cache:
+                self.soundFilePath = self.cache.Get(zippath, zipSoundFile)
+            if not self.soundFilePath:
+                self.soundFileData = zip.read(zipSoundFile)
+                if self.cache:
+                    self.soundFilePath = self.cache.Put(zippath, zipSoundFile,
+                                                        self.soundFileData)
+            if self.soundFilePath:
+                # Play the cached copy.
+                self.soundFileName = self.soundFilePath
+                self.soundFileData = None
+        finally:
+            zip.close()
+
+    def _readZipMember(self, zip, zippath, member):
+        """ Returns the contents of the zip member, from the cache if
+        it is there. """
+
+        if not self.cache:
+            return zip.read(member)
+
+        path = self.cache.Get(zippath, member)
+        if not path:
+            data = zip.read(member)
+            self.cache.Put(zippath, member, data)
+            return data
+
+        f = open(path, 'rb')
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+# cdgDecodeAhead Class
+#
+# Wraps a CdgPacketReader to decode the CDG stream in a thread of its
+# own, a little ahead of the song, so that a slow run of packets does
+# not hold up the next screen update (see cdgPlayer's decodeAhead
+# option).  It has the same interface as the reader, and the player
+# uses it in the reader's place.
+#
+# The decoding thread owns the real reader.  It decodes
+# DECODE_AHEAD_PACKETS packets at a time, and after each run publishes
+# a frame to a ring buffer of up to DECODE_AHEAD_FRAMES frames: the
+# packet position it was taken at, the list of tiles the reader
+# reported dirty and a copy of their pixels, the palette if it
+# changed, and the border colour.  DoPackets() only takes the frames
+# up to the new position off the buffer and merges them into its own
+# copy of the screen, which FillTile() draws from.  It waits for the
+# decoding thread only if that has fallen behind.  If the reader
+# raises an exception in the decoding thread, the thread stops, and
+# the exception is raised again here once the frames before it have
+# been taken.
+#
+# The picture therefore moves in steps of DECODE_AHEAD_PACKETS packets
+# (one frame at the default frame rate).  Seek() and Rewind() throw
+# away the frames decoded ahead, and start again at the new position
+# with a frame holding every tile.
+class cdgDecodeAhead:
+    def __init__(self, reader, cdgData, tileSurface):
+        self.__reader = reader
+        self.__numPackets = len(cdgData) / 24
+        # The decoding thread fills tiles onto this, to copy them.
+        self.__scratchTile = pygame.Surface((TILE_WIDTH, TILE_HEIGHT),
+                                            0, tileSurface)
+        self.__lastPalette = None
+
+        # Shared with the decoding thread, under __lock.  Each change
+        # of __generation tells it to start again at __startPos.
+        self.__lock = threading.Condition()
+        self.__frames = []
+        self.__generation = 0
+        self.__startPos = 0
+        self.__closed = False
+        self.__error = None
+
+        # Our own copy of the screen, as of packet __framePos.
+        self.__pos = 0
+        self.__framePos = None
+        self.__tiles = {}
+        self.__dirtyTiles = {}
+        self.__palette = None
+        self.__paletteChanged = False
+        self.__borderColour = None
+
+        self.__thread = threading.Thread(target=self.__decode)
+        self.__thread.setDaemon(True)
+        self.__thread.start()
+
+    def Close(self):
+        """ Stops the decoding thread. """
+        self.__lock.acquire()
+        try:
+            self.__closed = True
+            self.__lock.notifyAll()
+        finally:
+            self.__lock.release()
+        self.__thread.join()
+
+    def Rewind(self):
+        self.Seek(0)
+
+    def Seek(self, packetNum):
+        """ Moves the stream to the indicated packet.  All tiles are
+        marked dirty. """
+        packetNum = max(0, min(packetNum, self.__numPackets))
+        self.__lock.acquire()
+        try:
+            self.__generation += 1
+            self.__startPos = packetNum
+            self.__frames = []
+            self.__framePos = None
+            self.__lock.notifyAll()
+        finally:
+            self.__lock.release()
+        self.__pos = packetNum
+
+    def MarkTilesDirty(self):
+        self.__waitFor(self.__pos)
+        for tile in self.__tiles.keys():
+            self.__dirtyTiles[tile] = True
+
+    def GetDirtyTiles(self):
+        self.__waitFor(self.__pos)
+        # In the same order as the reader gives them.
+        tiles = [(col, row) for (row, col) in self.__dirtyTiles.keys()]
+        tiles.sort()
+        self.__dirtyTiles = {}
+        return [(row, col) for (col, row) in tiles]
+
+    def GetDirtyPalette(self):
+        self.__waitFor(self.__pos)
+        if not self.__paletteChanged:
+            return None
+        self.__paletteChanged = False
+        return self.__palette[:]
+
+    def GetBorderColour(self):
+        self.__waitFor(self.__pos)
+        return self.__borderColour
+
+    def DoPackets(self, numPackets):
+        if self.__pos >= self.__numPackets:
+            return (numPackets <= 0)
+        self.__pos = min(self.__pos + numPackets, self.__numPackets)
+        self.__waitFor(self.__pos)
+        return True
+
+    def FillTile(self, surface, row, col):
+        pygame.surfarray.blit_array(surface, self.__tiles[(row, col)])
+
+    # The remaining methods are private.
+
+    def __nextFramePos(self, pos):
+        return min((pos / DECODE_AHEAD_PACKETS + 1) * DECODE_AHEAD_PACKETS,
+                   self.__numPackets)
+
+    def __waitFor(self, pos):
+        """ Merges in the frames up to packet pos, waiting for the
+        decoding thread to get there if need be. """
+        self.__lock.acquire()
+        try:
+            while True:
+                while self.__frames and self.__frames[0][0] <= pos:
+                    self.__mergeFrame(self.__frames.pop(0))
+                    self.__lock.notifyAll()
+                if self.__framePos is not None and \
+                   (self.__framePos >= self.__numPackets or
+                    self.__nextFramePos(self.__framePos) > pos):
+                    return
+                if self.__error:
+                    # The decoding thread has stopped; no more frames
+                    # are coming.
+                    raise self.__error[0], self.__error[1], self.__error[2]
+                self.__lock.wait()
+        finally:
+            self.__lock.release()
+
+    def __mergeFrame(self, frame):
+        self.__framePos, tiles, dirtyTiles, palette, self.__borderColour = frame
+        self.__tiles.update(tiles)
+        for tile in dirtyTiles:
+            self.__dirtyTiles[tile] = True
+        if palette is not None:
+            self.__palette = palette
+            self.__paletteChanged = True
+
+    def __makeFrame(self, pos, restart):
+        reader = self.__reader
+        # After a restart the reader has marked every tile dirty.
+        dirtyTiles = reader.GetDirtyTiles()
+        tiles = {}
+        for (row, col) in dirtyTiles:
+            reader.FillTile(self.__scratchTile, row, col)
+            tiles[(row, col)] = pygame.surfarray.array2d(self.__scratchTile)
+        palette = reader.GetDirtyPalette()
+        if palette is not None:
+            self.__lastPalette = palette
+        elif restart:
+            palette = self.__lastPalette
+        return (pos, tiles, dirtyTiles, palette, reader.GetBorderColour())
+
+    def __decode(self):
+        """ The decoding thread. """
+        try:
+            self.__decodeFrames()
+        except:
+            # Hand the exception to the player, which would otherwise
+            # wait for the next frame for ever.
+            self.__lock.acquire()
+            try:
+                self.__error = sys.exc_info()
+                self.__lock.notifyAll()
+            finally:
+                self.__lock.release()
+
+    def __decodeFrames(self):
+        reader = self.__reader
+        generation = None
+        pos = 0
+        while True:
+            self.__lock.acquire()
+            try:
+                while not self.__closed and generation == self.__generation and \
+                      (len(self.__frames) >= DECODE_AHEAD_FRAMES or
+                       pos >= self.__numPackets):
+                    self.__lock.wait()
+                if self.__closed:
+                    return
+                restart = (generation != self.__generation)
+                generation = self.__generation
+                if restart:
+                    pos = self.__startPos
+            finally:
+                self.__lock.release()
+
+            if restart:
+                if hasattr(reader, 'Seek'):
+                    reader.Seek(pos)
+                else:
+                    reader.Rewind()
+                    reader.DoPackets(pos)
+                reader.MarkTilesDirty()
+            else:
+                end = self.__nextFramePos(pos)
+                reader.DoPackets(end - pos)
+                pos = end
+            frame = self.__makeFrame(pos, restart)
+
+            self.__lock.acquire()
+            try:
+                if generation == self.__generation:
+                    self.__frames.append(frame)
+                    self.__lock.notifyAll()
+            finally:
+                self.__lock.release()
+
 # cdgPlayer Class
 class cdgPlayer(pykPlayer):
+    # If set, shutdown() leaves the pygame display and mixer open for
+    # the next player, which reuses them if it can, so that there is
+    # no gap or flicker between songs.  Call closeSession() when done.
+    keepSession = False
+    # If set, songs in zip archives are read through this cache (see
+    # cdgSong).
+    zipCache = None
+
     # Initialise the player instace
 
     def __init__(
@@ -229,7 +733,12 @@ class cdgPlayer(pykPlayer):
             zippath=None,
             offsetTime=0,
             errorNotifyCallback=None,
-            doneCallback=None
+            doneCallback=None,
+            frameRate=DEFAULT_FRAME_RATE,
+            song=None,
+            audioProperties=None,
+            decodeAhead=False,
+            sound=True
         ):
 
         pykPlayer.__init__(self, cdgfile, errorNotifyCallback, doneCallback)
@@ -237,78 +746,97 @@ class cdgPlayer(pykPlayer):
         # With the nomusic option no music will be played.
         soundFileData = None
         self.State = STATE_INIT
+        # Set when the song closes because it has come to its end,
+        # rather than being closed from the keyboard or the window.
+        self.songFinished = False
         self.InternalOffsetTime = offsetTime
-        self.PlayTime = 0
-        self.PlayStartTime = 0
         self.PlayFrame = 0
         self.displaySize = size
         self.fullScreen = fullscreen 
-        self.tempdir = tempfile.mkdtemp()
-        # Check for a matching mp3 or ogg file.  Check extensions
-        # in the following order.
-        self.validexts = [
-            '.wav', '.ogg', '.mp3'
-        ]
-
-        print "Get soundFileData"
-        if zippath:
-            print "Opening zip, %s" % zippath
-            cdgfile, soundFilePath = self._extractZipData(cdgfile, zippath)
-        else:
-            basepath = os.path.splitext(cdgfile)[0]
-            soundFilePath = None
-            candidates = glob.glob("%s.*" % basepath)
-            for candidate in candidates:
-                name, ext = os.path.splitext(candidate)
-                if ext.lower() in self.validexts:
-                    soundFilePath = candidate
-                    break
-
-            if not soundFilePath:
-                ErrorString = "There is no mp3 or ogg file to match :", cdgfile 
-                self.ErrorNotifyCallback (ErrorString)
-                raise 'NoSoundFile'
 
-        print "Get cdg file data."
-        f = open(cdgfile, 'rb')
-        try:
-            self.cdgFileData = f.read()
-        finally:
-            f.close()
+        # Set to wake WaitForPlayer() before its sleep is up.
+        self.wakeEvent = threading.Event()
+        # The song's files, prefetched by the caller or loaded now.
+        # tempdir is only made if a sound file has to be extracted
+        # from a zip for the mixer.
+        self.tempdir = None
+        self.soundFileObject = None
+        if not song or not song.Matches(cdgfile, zippath):
+            song = cdgSong(cdgfile, zippath, self.ErrorNotifyCallback,
+                           self.zipCache, sound)
+        song.Load()
+        self.cdgFileData = song.cdgFileData
 
         # Handle a bug in pygame (pre-1.7) which means that the position
         # timer carries on even when the song has been paused.
         self.pauseOffsetTime = 0
         self.cdgZoom = 'soft'
+        self.softTiles = None
+        self.softTilesDue = None
+        # Render through 8-bit palettized working surfaces, so that a
+        # colour table change only updates the 16-entry palette.  This
+        # is only supported by the Python CDG interpreter.
+        self.cdgPalette = True
         self.displayDepth = 8
         self.displayFlags = pygame.RESIZABLE | pygame.HWSURFACE
         if self.fullScreen:
             self.displayFlags |= pygame.FULLSCREEN
 
+        # audioProperties, if given, is the sound file's (sample rate,
+        # channels, length in seconds), found when the song was added
+        # to the caller's library.
+        self.mixerSettings = MIXER_SETTINGS
+        self.soundLength = None
+        if audioProperties:
+            rate, channels, self.soundLength = audioProperties
+            self.mixerSettings = (rate, MIXER_SETTINGS[1], channels,
+                                  MIXER_SETTINGS[3])
+
         print "Init player"
-        pygame.mixer.pre_init(44100, -16, 2, 4096)    
-        pygame.init()
-        pygame.mixer.init(44100, -16, 2, 4096)    
-        #pygame.mixer.pre_init(44100, -16, 2)    
-        pygame.display.init()
+        self.openSession()
         pygame.display.set_caption(cdgfile)
         #pygame.mouse.set_visible(True)
         pygame.mouse.set_visible(False)
-        self.display = pygame.display.set_mode(self.displaySize, self.displayFlags)
         self.displayTime = pygame.time.get_ticks()
         self.display.fill((100,100,100))
 
+        aux = aux_c
+        if not aux: 
+            print "Using Python implementation of CDG interpreter."
+            aux = aux_python
+        else:
+            print "Using C based CDG interpreter."
+            self.cdgPalette = False
+
         print "Fill surface"
         self.surface = pygame.Surface(self.displaySize)
         self.surface.fill((128, 128, 0))
-        # A working surface for blitting tiles, one at a time.
-        self.workingTile = pygame.Surface((TILE_WIDTH, TILE_HEIGHT),
-                                          0, self.surface)
+        # A working surface for blitting tiles, one at a time.  In
+        # palette mode this is an 8-bit surface holding the colour
+        # indeces, and the packet reader hands us the palette.
+        if self.cdgPalette:
+            self.workingTile = pygame.Surface((TILE_WIDTH, TILE_HEIGHT),
+                                              0, 8)
+        else:
+            self.workingTile = pygame.Surface((TILE_WIDTH, TILE_HEIGHT),
+                                              0, self.surface)
+
+        # In palette mode, an 8-bit surface holding the colour indeces
+        # of the whole screen, so that when the palette changes the
+        # screen can be drawn again in the new colours without asking
+        # the packet reader for the tiles again.
+        if self.cdgPalette:
+            self.indexSurface = pygame.Surface((CDG_DISPLAY_WIDTH, CDG_DISPLAY_HEIGHT),
+                                               0, 8)
+        else:
+            self.indexSurface = None
 
         # A surface that contains the set of all tiles as they are to
         # be assembled onscreen.  This surface is kept at the original
         # scale, then zoomed to display size.  It is only used if
-        # settings.CdgZoom == 'soft'.
+        # settings.CdgZoom == 'soft'.  It is always in the display's
+        # format, even in palette mode, since rotozoom() would
+        # otherwise convert it to 32 bits each time.
         self.workingSurface = pygame.Surface((CDG_DISPLAY_WIDTH, CDG_DISPLAY_HEIGHT),
                                              pygame.HWSURFACE,
                                              self.surface)
@@ -316,35 +844,24 @@ class cdgPlayer(pykPlayer):
         self.borderColour = None
         print "Compute display size"
         self.computeDisplaySize()
-        aux = aux_c
-        if not aux: 
-            print "Using Python implementation of CDG interpreter."
-            aux = aux_python
-        else:
-            print "Using C based CDG interpreter."
         print "Open cdg and sound files"
         # Open the cdg and sound files
-        self.packetReader = aux.CdgPacketReader(self.cdgFileData, self.workingTile)
+        if self.cdgPalette and song.packetReader:
+            self.packetReader = song.packetReader
+        else:
+            self.packetReader = aux.CdgPacketReader(self.cdgFileData, self.workingTile)
         print "test for sound file data"
-        if soundFilePath:
+        if song.soundFileName:
             print "YES"
             # Play the music normally.
-            audioProperties = None
-            print "Use mp3 settings?"
-            #if manager.settings.UseMp3Settings:
-            print "Get audio properties"
-            audioProperties = self.getAudioProperties(soundFilePath)
-            #    print self.soundFileData
-            print audioProperties
-
-            if audioProperties == None:
-                print "None audio properties"
-                audioProperties = (None, None, None)
             try:
-                print "Try open audio"
-                #manager.OpenAudio(*audioProperties)
-                print "Try music load: ", soundFilePath
-                pygame.mixer.music.load(soundFilePath)
+                print "Try music load: ", song.soundFileName
+                if song.soundFileData is None:
+                    pygame.mixer.music.load(song.soundFilePath)
+                elif not self.loadSoundFileData(song):
+                    print "Extracting sound file"
+                    self.tempdir = tempfile.mkdtemp()
+                    pygame.mixer.music.load(song.WriteSoundFile(self.tempdir))
                 print "OK"
             except:
                 print "Oh noes!"
@@ -356,8 +873,16 @@ class cdgPlayer(pykPlayer):
             pygame.mixer.music.set_endevent(pygame.USEREVENT)
 
         else:
-            # Don't play anything.
-            self.InternalOffsetTime = 0
+            # Don't play anything.  The sound is put with the frames
+            # later (see Capture()), so the offset stays.
+            pass
+
+        # Start decoding ahead only once the song has loaded, so that
+        # a song that fails does not leave the thread behind.
+        if decodeAhead:
+            self.packetReader = cdgDecodeAhead(self.packetReader,
+                                               self.cdgFileData,
+                                               self.workingTile)
             
         print "set to beginning"
         # Set the CDG file at the beginning
@@ -365,8 +890,31 @@ class cdgPlayer(pykPlayer):
         self.cdgPacketsDue = 0
         self.LastPos = self.curr_pos = 0
 
+        # Seek() only records the requested position; the seek itself
+        # is done by the player thread, in doStuff().  seekOffsetTime
+        # is the song position at which the music was last (re)started,
+        # since get_pos() counts from there.
+        self.seekRequest = None
+        self.seekOffsetTime = 0
+
         # Some session-wide constants.
-        self.ms_per_update = (1000.0 / 30)        
+        if frameRate <= 0:
+            print "Bad frame rate %s, using %d" % (frameRate, DEFAULT_FRAME_RATE)
+            frameRate = DEFAULT_FRAME_RATE
+        self.ms_per_update = (1000.0 / frameRate)
+
+        # Frame pacing (see cdgPaceFrame()).  frameInterval is the
+        # time between frames actually in use, nextFrameTime the song
+        # position at which the next frame is due, and frameCost the
+        # average time cdgDisplayUpdate() takes.  framesLate counts
+        # the frames drawn more than half a frame late, and
+        # framesDropped the frames skipped altogether.
+        self.frameInterval = self.ms_per_update
+        self.nextFrameTime = 0
+        self.frameCost = 0.0
+        self.framesDrawn = 0
+        self.framesLate = 0
+        self.framesDropped = 0
 
     def __del__(self):
         if self.tempdir:
@@ -374,18 +922,55 @@ class cdgPlayer(pykPlayer):
             self.tempdir = None
         pykPlayer.__del__(self)
 
+    def openSession(self):
+        """ Initialises pygame and opens the mixer and the display,
+        keeping the ones left open by the previous player (see
+        keepSession) if they have the right settings. """
+
+        if pygame.mixer.get_init() != self.mixerSettings[:3]:
+            pygame.mixer.quit()
+            pygame.mixer.pre_init(*self.mixerSettings)
+        pygame.init()
+        pygame.mixer.init(*self.mixerSettings)
+        pygame.display.init()
+
+        display = pygame.display.get_surface()
+        if display == None or display.get_size() != tuple(self.displaySize) or \
+           bool(display.get_flags() & pygame.FULLSCREEN) != self.fullScreen:
+            display = pygame.display.set_mode(self.displaySize, self.displayFlags)
+        self.display = display
+
+        # Forget any end of music event left over from the last song.
+        pygame.event.clear(pygame.USEREVENT)
+
     def initPlayer(self):
         #pygame.mixer.pre_init(44100, -16, 2, 1024)    
         pygame.init()
 
     def WaitForPlayer(self):
         while self.State != STATE_CLOSED:
-            try:
-                self.Poll()
-            except RuntimeError:
-                self.State = STATE_PLAYING
-                ret = pygame.mixer.music.play()
-                print "Played ret:", ret
+            self.handleEvents()
+            self.doStuff()
+            if self.State == STATE_CLOSED:
+                break
+            waitTime = self.GetWaitTime()
+            if waitTime > 0:
+                self.wakeEvent.wait(waitTime / 1000.0)
+            self.wakeEvent.clear()
+
+    def GetWaitTime(self):
+        """ Returns the number of milliseconds until the player next
+        has any work to do: until the next screen update is due while
+        playing, or PLAYER_IDLE_WAIT while paused or stopped. """
+
+        if self.State == STATE_PLAYING:
+            pos = self.clock.GetPos() + self.InternalOffsetTime
+            waitTime = self.nextFrameTime - pos
+            return int(min(max(waitTime, 0), PLAYER_IDLE_WAIT))
+        elif self.State == STATE_CLOSING or self.State == STATE_CAPTURING:
+            return 0
+        else:
+            return PLAYER_IDLE_WAIT
 
     def handleEvent(self, event):
         # Only handle resize events 250ms after opening the
@@ -408,6 +993,7 @@ class cdgPlayer(pykPlayer):
             self.doResizeEnd()
         elif event.type == pygame.USEREVENT:
             print "Done playing, exiting..."
+            self.songFinished = True
             self.Close()
         elif event.type == pygame.QUIT:
             print "pycdg Close"
@@ -465,12 +1051,101 @@ class cdgPlayer(pykPlayer):
         self.pauseOffsetTime = self.pauseOffsetTime + (self.GetPos() - self.PauseStartTime)
         pygame.mixer.music.unpause()
 
+    def Pause(self):
+        pykPlayer.Pause(self)
+        self.wakeEvent.set()
+
+    def Close(self):
+        pykPlayer.Close(self)
+        self.wakeEvent.set()
+
+    # Jump to the indicated position in the song (in milliseconds).
+    def Seek(self, pos):
+        self.seekRequest = pos
+        self.wakeEvent.set()
+
+    def Capture(self, dumpFile, dumpFormat='y4m', frameRate=None):
+        """ Renders the song frame by frame into dumpFile (an open
+        file), as fast as the frames can be drawn rather than in time
+        with the music, which is not played.  dumpFormat is one of
+        DUMP_FORMATS; frameRate defaults to the player's own.  Call
+        WaitForPlayer() to run it; the player closes at the end of the
+        CDG stream.  The frames can then be put together with the
+        sound file by a video encoder. """
+
+        if dumpFormat not in DUMP_FORMATS:
+            raise ValueError, "Unknown dump format %s" % dumpFormat
+        width, height = self.display.get_size()
+        if dumpFormat == 'y4m':
+            if N is None:
+                raise ImportError, "YUV4MPEG2 dumps need the Numeric module"
+            if width % 2 or height % 2:
+                raise ValueError, "YUV4MPEG2 dumps need an even width and height"
+
+        self.dumpFile = dumpFile
+        self.dumpFormat = dumpFormat
+        self.dumpFrameRate = frameRate or int(1000.0 / self.ms_per_update + 0.5)
+        self.framesDumped = 0
+        if dumpFormat == 'y4m':
+            dumpFile.write("YUV4MPEG2 W%d H%d F%d:1 Ip A1:1 C420jpeg\n" % (
+                width, height, self.dumpFrameRate))
+
+        # Draw the first frame now; doStuff() dumps each frame and
+        # then draws the next.
+        self.Rewind()
+        self.packetReader.MarkTilesDirty()
+        self.cdgDisplayUpdate()
+        self.State = STATE_CAPTURING
+
+    def doFrameDump(self):
+        if self.dumpFormat == 'rgb':
+            self.dumpFile.write(pygame.image.tostring(self.display, 'RGB'))
+        else:
+            width, height = self.display.get_size()
+            self.dumpFile.write("FRAME\n")
+            self.dumpFile.write(rgbToYuv420(
+                pygame.image.tostring(self.display, 'RGB'), width, height))
+        self.framesDumped += 1
+
+    def doSeek(self, pos):
+        # Restart the music at the new position.  Seeking is only
+        # meaningful once the song has been started.
+        if self.State == STATE_PLAYING or self.State == STATE_PAUSED:
+            try:
+                pygame.mixer.music.play(0, pos / 1000.0)
+            except pygame.error:
+                print "Cannot seek in this sound file."
+                return
+            if self.State == STATE_PAUSED:
+                pygame.mixer.music.pause()
+                self.PauseStartTime = pos
+        self.seekOffsetTime = pos
+        self.clock.SetPos(pos)
+
+        # Bring the CDG decoder to the matching packet.  The Python
+        # interpreter can restore a nearby snapshot; otherwise decode
+        # from the start of the stream.
+        self.curr_pos = pos + self.InternalOffsetTime
+        self.cdgReadPackets = max(int((self.curr_pos * 300) / 1000), 0)
+        if hasattr(self.packetReader, 'Seek'):
+            self.packetReader.Seek(self.cdgReadPackets)
+        else:
+            self.packetReader.Rewind()
+            self.packetReader.DoPackets(self.cdgReadPackets)
+        self.packetReader.MarkTilesDirty()
+        self.cdgDisplayUpdate()
+        self.LastPos = self.curr_pos
+        self.nextFrameTime = self.curr_pos + self.frameInterval
+
     # you must call Play() to restart. Blocks until pygame is initialised
     def doRewind(self):
         # Reset the state of the packet-reading thread
         self.cdgReadPackets = 0
         self.cdgPacketsDue = 0
         self.LastPos = 0
+        self.nextFrameTime = 0
+        self.seekRequest = None
+        self.seekOffsetTime = 0
         # No need for the Pause() fix anymore
         self.pauseOffsetTime = 0
         # Move file pointer to the beginning of the file
@@ -481,15 +1156,24 @@ class cdgPlayer(pykPlayer):
         pygame.mixer.music.rewind()
         pygame.mixer.music.stop()
 
-    # Get the current time (in milliseconds). Blocks if pygame is
-    # not initialised yet.
+    # Get the current time (in milliseconds), from the playback
+    # clock, first steering the clock towards the music position.
     def GetPos(self):
-        pos = pygame.mixer.music.get_pos()
-        if pos < 0:
-            print "Negative GetPOS (%s), this is not normal" % pos
-            raise RuntimeError, "GetPOS Failed."
-        else:
-            return pos
+        if self.State == STATE_PLAYING:
+            try:
+                pos = pygame.mixer.music.get_pos()
+            except pygame.error:
+                pos = -1
+            if pos >= 0:
+                self.clock.Sync(pos + self.seekOffsetTime)
+        return self.clock.GetPos()
+
+    # Get the song length (in seconds), as given by the sound file if
+    # the caller told us, or else by the length of the CDG stream.
+    def GetLength(self):
+        if self.soundLength:
+            return self.soundLength
+        return len(self.cdgFileData) / (24 * 300.0)
 
     def SetupOptions(self):
         """ Initialise and return optparse OptionParser object,
@@ -507,26 +1191,41 @@ class cdgPlayer(pykPlayer):
     def shutdown(self):
         # This will be called by the pykManager to shut down the thing
         # immediately.
-        #pygame.mixer.music.stop()
+        print "Frames drawn %d, late %d, dropped %d, %.1f per second" % self.GetFrameStats()
         #pygame.mixer.music = None
-        pygame.mixer.quit()
+        if not self.keepSession:
+            pygame.mixer.quit()
+        elif pygame.mixer.get_init():
+            # Stop the music without it reporting that the song has
+            # finished, which the next player would take for its own.
+            pygame.mixer.music.set_endevent()
+            pygame.mixer.music.stop()
 
         # Make sure our surfaces are deallocated before we call up to
         # CloseDisplay(), otherwise bad things can happen.
         self.workingSurface = None
+        self.indexSurface = None
         self.workingTile = None
+        if isinstance(self.packetReader, cdgDecodeAhead):
+            self.packetReader.Close()
         self.packetReader = None
         pykPlayer.shutdown(self)
-        pygame.display.quit()
+        if not self.keepSession:
+            pygame.display.quit()
         if self.tempdir:
             shutil.rmtree(self.tempdir)
             self.tempdir = None
             
     def doStuff(self):
         pykPlayer.doStuff(self)
+        if self.seekRequest is not None:
+            pos, self.seekRequest = self.seekRequest, None
+            self.doSeek(pos)
+
         # Check whether the songfile has moved on, if so
         # get the relevant CDG data and update the screen.
-        if self.State == STATE_PLAYING or self.State == STATE_CAPTURING:
+        capturing = (self.State == STATE_CAPTURING)
+        if self.State == STATE_PLAYING or capturing:
             #self.curr_pos = self.GetPos() + self.InternalOffsetTime + manager.settings.SyncDelayMs - self.pauseOffsetTime
             self.curr_pos = self.GetPos() + self.InternalOffsetTime
 
@@ -536,31 +1235,74 @@ class cdgPlayer(pykPlayer):
                 if not self.packetReader.DoPackets(numPackets):
                     # End of file.
                     print "End of file on cdg."
+                    self.songFinished = True
                     self.Close()
                 self.cdgReadPackets += numPackets
 
-            # Check if any screen updates are now due.
-            if (self.curr_pos - self.LastPos) > self.ms_per_update:
+            # Check if any screen updates are now due.  When capturing
+            # every call is a frame.
+            if capturing:
                 self.cdgDisplayUpdate()
-                self.LastPos = self.curr_pos
+            elif self.curr_pos >= self.nextFrameTime or \
+               self.nextFrameTime - self.curr_pos > self.frameInterval:
+                self.cdgPaceFrame()
+
+    def cdgPaceFrame(self):
+        """ Draws the frame that is now due, counting it as late if it
+        is more than half a frame late, and counting any frames which
+        were due before it as dropped.  Then schedules the next frame
+        on the same grid, spacing frames out if drawing them is taking
+        too much of the time. """
+
+        late = self.curr_pos - self.nextFrameTime
+        if late < 0:
+            # The clock has been stepped back; start a new grid.
+            self.nextFrameTime = self.curr_pos
+            late = 0
+        missed = int(late / self.frameInterval)
+        self.framesDropped += missed
+        if late > self.frameInterval / 2:
+            self.framesLate += 1
+
+        start = pygame.time.get_ticks()
+        self.cdgDisplayUpdate()
+        cost = pygame.time.get_ticks() - start
+        self.framesDrawn += 1
+        self.LastPos = self.curr_pos
+
+        self.nextFrameTime += (missed + 1) * self.frameInterval
+        self.frameCost += (cost - self.frameCost) * FRAME_COST_SMOOTHING
+        self.frameInterval = min(max(self.ms_per_update, self.frameCost / FRAME_LOAD),
+                                 1000.0 / MIN_FRAME_RATE)
+
+    def GetFrameStats(self):
+        """ Returns (frames drawn, frames late, frames dropped) since
+        the song was started, and the current frame rate. """
+
+        return (self.framesDrawn, self.framesLate, self.framesDropped,
+                1000.0 / self.frameInterval)
 
     #def handleEvent(self, event):
     #    pykPlayer.handleEvent(self, event)
 
     def doResize(self, newSize):
         print "doResize"
-        self.computeDisplaySize()
+        # More resizes are likely to follow while the window is being
+        # dragged.
+        self.computeDisplaySize(deferSoftTiles = True)
     
         if self.borderColour != None:
             self.surface.fill(self.borderColour)
 
         self.packetReader.MarkTilesDirty()
 
-    def computeDisplaySize(self):
+    def computeDisplaySize(self, deferSoftTiles = False):
         print "ComputeDisplaySize"
         """ Figures out what scale and placement to use for blitting
         tiles to the screen.  This must be called at startup, and
-        whenever the window size changes. """
+        whenever the window size changes.  If deferSoftTiles is set,
+        the tiles for 'soft' zoom mode are worked out later (see
+        SOFT_TILE_DELAY), unless they are already known. """
         
         winWidth, winHeight = self.displaySize
 
@@ -594,57 +1336,35 @@ class cdgPlayer(pykPlayer):
         if self.cdgZoom == 'soft':
             self.displayTileWidth = CDG_DISPLAY_WIDTH / TILES_PER_ROW
             self.displayTileHeight = CDG_DISPLAY_HEIGHT / TILES_PER_COL
+            if deferSoftTiles and self.displayScale not in softTileCache:
+                self.softTiles = None
+                self.softTilesDue = pygame.time.get_ticks() + SOFT_TILE_DELAY
+            else:
+                self.computeSoftTiles()
         else:
             self.displayTileWidth = scaledWidth / TILES_PER_ROW
             self.displayTileHeight = scaledHeight / TILES_PER_COL
 
-    def getAudioProperties(self, soundFilePath):
-        """ Attempts to determine the samplerate, etc., from the
-        specified filename.  It would be nice to know this so we can
-        configure the audio hardware to the same properties, to
-        minimize run-time resampling. """
-
-        # Ideally, SDL would tell us this (since it knows!), but
-        # SDL_mixer doesn't provide an interface to query this
-        # information, so we have to open the soundfile separately and
-        # try to figure it out ourselves.
-
-        audioProperties = None
-        ext = os.path.splitext(soundFilePath)[1]
-        print "MP3?", ext
-        if ext == '.mp3':
-            print "Yes mp3!"
-            audioProperties = self.getMp3AudioProperties(soundFilePath)
+    def loadSoundFileData(self, song):
+        """ Loads the song's sound file into the mixer from the data
+        read from its zip, without writing it out to disk.  Returns
+        False if the mixer cannot play it that way. """
 
-        return audioProperties
-
-    def getMp3AudioProperties(self, soundFilePath):
-        """ Attempts to determine the samplerate, etc., from the
-        specified filename, which is known to be an mp3 file. """
-
-        # Hopefully, we have MP3Info.py available.
+        # The mixer reads from the file object as the song plays, so
+        # we must hold on to it.
+        self.soundFileObject = cStringIO.StringIO(song.soundFileData)
         try:
-            print "Try importing MP3Info"
-            import MP3Info
-            print "OK"
-        except:
-            print "FAIL!"
-            return None
-
-        import cStringIO
-        f = open(soundFilePath, 'rb')
-        try:
-            data = f.read()
-        finally:
-            f.close()
-        m = MP3Info.MPEG(cStringIO.StringIO(data))
-
-        channels = 1
-        if 'stereo' in m.mode:
-            channels = 2
-
-        audioProperties = (m.samplerate, -16, channels)
-        return audioProperties
+            if pygame.version.vernum[0] >= 2:
+                # Tell it the type, in case it cannot tell from the
+                # data.
+                ext = os.path.splitext(song.soundFileName)[1]
+                pygame.mixer.music.load(self.soundFileObject, ext[1:].lower())
+            else:
+                pygame.mixer.music.load(self.soundFileObject)
+        except (pygame.error, TypeError):
+            self.soundFileObject = None
+            return False
+        return True
 
     # Actually update/refresh the video output
     def cdgDisplayUpdate(self):
@@ -692,9 +1412,16 @@ class cdgPlayer(pykPlayer):
         #   after all dirty tiles have been blitted to
         #   self.workingSurface, we use pygame.transform.rotozoom() to
         #   make a nice, antialiased scaling of workingSurface to
-        #   manager.surface, and then flip the whole display.  (We
-        #   can't scale and blit the tiles one a time in this mode,
-        #   since that introduces artifacts between the tile edges.)
+        #   manager.surface.  When only some of the tiles are dirty,
+        #   each one is scaled separately together with a few pixels
+        #   of its neighbours (see computeSoftTiles()), so that there
+        #   are no artifacts at the tile edges; the padding is then
+        #   cropped off and only the rectangles of the dirty tiles are
+        #   updated.  When so many tiles are dirty that this would
+        #   scale more than half as many pixels as the whole screen
+        #   (scaling many small surfaces has its own overhead), the
+        #   whole of workingSurface is scaled instead and the display
+        #   flipped.
         
         borderColour = self.packetReader.GetBorderColour()
         if borderColour != self.borderColour:
@@ -706,42 +1433,55 @@ class cdgPlayer(pykPlayer):
                 self.surface.fill(borderColour)
                 self.packetReader.MarkTilesDirty()
 
+        paletteChanged = False
+        if self.cdgPalette:
+            palette = self.packetReader.GetDirtyPalette()
+            if palette:
+                # The colour table has changed.  Both 8-bit surfaces
+                # get the same palette, so that blitting a tile onto
+                # indexSurface copies the colour indeces unchanged.
+                paletteChanged = True
+                self.workingTile.set_palette(palette)
+                self.indexSurface.set_palette(palette)
+
         dirtyTiles = self.packetReader.GetDirtyTiles()
-        if not dirtyTiles:
+        if not dirtyTiles and not paletteChanged:
             # If no tiles are dirty, don't bother.
             return
 
         # List of update rectangles (in scaled output window)
         rect_list = []
 
-        # Scale and blit only those tiles which have been updated
+        # Scale and blit only those tiles which have been updated.
+        # Tiles already on the display were drawn in the old colours,
+        # so when the palette changes they are all drawn again, from
+        # indexSurface, without asking the packet reader for them.
         for row, col in dirtyTiles:
             self.packetReader.FillTile(self.workingTile, row, col)
-
-            if self.cdgZoom == 'none':
-                # The no-scale approach.
-                rect = pygame.Rect(self.displayTileWidth * row + self.displayRowOffset,
-                                   self.displayTileHeight * col + self.displayColOffset,
-                                   self.displayTileWidth, self.displayTileHeight)
-                self.surface.blit(self.workingTile, rect)
-                self.display.blit(self.workingTile, rect)
-                rect_list.append(rect)
-
-            elif self.cdgZoom == 'soft':
-                # The soft-scale approach.
-                self.workingSurface.blit(self.workingTile, (self.displayTileWidth * row, self.displayTileHeight * col))
-
+            if self.cdgPalette:
+                self.indexSurface.blit(self.workingTile, (TILE_WIDTH * row, TILE_HEIGHT * col))
+            if not paletteChanged:
+                self.cdgDrawTile(self.workingTile, row, col, rect_list)
+        if paletteChanged:
+            if self.cdgZoom == 'soft':
+                self.workingSurface.blit(self.indexSurface, (0, 0))
             else:
-                # The quick-scale approach.
-                scaled = pygame.transform.scale(self.workingTile, (self.displayTileWidth,self.displayTileHeight))
-                rect = pygame.Rect(self.displayTileWidth * row + self.displayRowOffset,
-                                   self.displayTileHeight * col + self.displayColOffset,
-                                   self.displayTileWidth, self.displayTileHeight)
-                self.surface.blit(scaled, rect)
-                self.display.blit(scaled, rect)
-                rect_list.append(rect)
-
-        if self.cdgZoom == 'soft':
+                for row in range(TILES_PER_ROW):
+                    for col in range(TILES_PER_COL):
+                        tile = self.indexSurface.subsurface(
+                            (TILE_WIDTH * row, TILE_HEIGHT * col, TILE_WIDTH, TILE_HEIGHT))
+                        self.cdgDrawTile(tile, row, col, rect_list)
+
+        if self.cdgZoom == 'soft' and self.softTilesDue is not None and \
+           pygame.time.get_ticks() >= self.softTilesDue:
+            self.computeSoftTiles()
+
+        if self.cdgZoom == 'soft' and self.softTiles and not paletteChanged and \
+           self.softTilesArea(dirtyTiles) < CDG_DISPLAY_WIDTH * CDG_DISPLAY_HEIGHT / 2:
+            # Scale and blit just the dirty tiles.
+            rect_list = self.cdgSoftZoomTiles(dirtyTiles)
+            pygame.display.update(rect_list)
+        elif self.cdgZoom == 'soft':
             # Now scale and blit the whole screen.
             scaled = pygame.transform.rotozoom(self.workingSurface, 0, self.displayScale)
             self.surface.blit(scaled, (self.displayRowOffset, self.displayColOffset))
@@ -757,61 +1497,203 @@ class cdgPlayer(pykPlayer):
 
         #pygame.display.update()
 
-    def _extractZipData(self, cdgfile, zippath):
-        cdgFilePath = None
-        soundFilePath = None
-        basepath = os.path.splitext(cdgfile)[0]
-
-        zip = zipfile.ZipFile(zippath)
-        try:
-            namelist = zip.namelist()
-            zipSoundFile = None
-
-            if cdgfile not in namelist:
-                self.ErrorNotifyCallback("Not cdg match in archive for" % cdgfile)
-                raise "NoCDGFile"
-
-            for ext in self.validexts:
-                tempsound = "%s%s" % (basepath, ext)
-                if tempsound in namelist:
-                    zipSoundFile = tempsound
-                    break
-            if not zipSoundFile:
-                ErrorString = "There is no mp3 or ogg file to match :", cdgfile 
-                self.ErrorNotifyCallback (ErrorString)
-                raise 'NoSoundFile'
+    def cdgDrawTile(self, tile, row, col, rect_list):
+        """ Blits the indicated tile, from the tile-sized surface
+        tile, to the display (or to workingSurface in 'soft' zoom
+        mode), adding the display rectangle updated to rect_list. """
 
-            #
-            # ZipFile.extract not available pre python 2.6
-            #
-            zip.extract(cdgfile, self.tempdir)
-            zip.extract(zipSoundFile, self.tempdir)
-        
-            #self._writeZipMember(zippath, cdgfile, self.tempdir)
-            #self._writeZipMember(zippath, zipSoundFile, self.tempdir)
+        if self.cdgZoom == 'none':
+            # The no-scale approach.
+            rect = pygame.Rect(self.displayTileWidth * row + self.displayRowOffset,
+                               self.displayTileHeight * col + self.displayColOffset,
+                               self.displayTileWidth, self.displayTileHeight)
+            self.surface.blit(tile, rect)
+            self.display.blit(tile, rect)
+            rect_list.append(rect)
+
+        elif self.cdgZoom == 'soft':
+            # The soft-scale approach.
+            self.workingSurface.blit(tile, (self.displayTileWidth * row, self.displayTileHeight * col))
 
-            soundFilePath = os.path.join(self.tempdir, zipSoundFile)
-            cdgFilePath = os.path.join(self.tempdir, cdgfile)
-        finally:
-            zip.close()
+        else:
+            # The quick-scale approach.
+            scaled = pygame.transform.scale(tile, (self.displayTileWidth,self.displayTileHeight))
+            rect = pygame.Rect(self.displayTileWidth * row + self.displayRowOffset,
+                               self.displayTileHeight * col + self.displayColOffset,
+                               self.displayTileWidth, self.displayTileHeight)
+            self.surface.blit(scaled, rect)
+            self.display.blit(scaled, rect)
+            rect_list.append(rect)
+
+    def cdgSoftZoomTiles(self, dirtyTiles):
+        """ Scales the indicated tiles of self.workingSurface with
+        rotozoom() and blits them to the display, returning the list
+        of display rectangles updated. """
 
-        return cdgFilePath, soundFilePath
+        rect_list = []
+        for tile in dirtyTiles:
+            srcRect, zoom, area, dest = self.softTiles[tile]
+            scaled = pygame.transform.rotozoom(
+                self.workingSurface.subsurface(srcRect), 0, zoom)
+            self.surface.blit(scaled, dest, area)
+            rect_list.append(self.display.blit(scaled, dest, area))
+
+        return rect_list
+
+    def softTilesArea(self, tiles):
+        """ Returns the number of workingSurface pixels that
+        cdgSoftZoomTiles() would scale for the indicated tiles. """
+
+        area = 0
+        for tile in tiles:
+            srcRect = self.softTiles[tile][0]
+            area += srcRect.width * srcRect.height
+        return area
+
+    def computeSoftTiles(self):
+        """ Sets self.softTiles for the current display scale and
+        placement, from softTileCache if it can (see
+        layoutSoftTiles()).  This must be called whenever the display
+        scale changes. """
+
+        self.softTilesDue = None
+        scale = self.displayScale
+        if scale not in softTileCache:
+            if len(softTileCache) >= SOFT_TILE_CACHE:
+                softTileCache.clear()
+            softTileCache[scale] = self.layoutSoftTiles()
+        layout = softTileCache[scale]
+        if layout is None:
+            self.softTiles = None
+            return
 
-    def _writeZipMember(self, zippath, member, outpath):
-        temppath = os.path.join(outpath, member)
-        tempdir = os.path.dirname(temppath)
-        if not os.path.isdir(tempdir):
-            os.makedirs(tempdir)
-        f = open(temppath, 'w')
-        try:
-            zip = zipfile.ZipFile(zippath)
-            try:
-                data = zip.read(member)
-                f.write(data)
-            finally:
-                zip.close()
-        finally:
-            f.close()
+        self.softTiles = {}
+        for tile, (srcRect, zoom, area, (x, y)) in layout.items():
+            self.softTiles[tile] = (srcRect, zoom, area,
+                                    (x + self.displayRowOffset, y + self.displayColOffset))
+
+    def layoutSoftTiles(self):
+        """ Works out, for each tile, which area of workingSurface to
+        scale, by how much, and which part of the result to blit
+        where (relative to the letterboxed picture), for
+        cdgSoftZoomTiles(), at the current display scale.
+
+        rotozoom() samples destination pixel x at source position
+        x * (w - 1) / int(w * zoom), where w is the source width.  The
+        scaled tiles must sample the same positions as scaling the
+        whole of workingSurface would, or they would not line up with
+        the tiles around them.  So each tile is scaled together with
+        SOFT_TILE_PAD or more pixels of its neighbours, choosing the
+        padding and zoom whose sample positions come closest to the
+        whole-screen ones.  The padding is then cropped off again,
+        keeping one source pixel's worth of overlap into the
+        neighbouring tiles, whose edges are blended with this tile's
+        pixels.  If no suitable zoom can be found for some tile, None
+        is returned, and the whole screen is always scaled instead. """
+
+        layout = {}
+
+        # rotozoom() takes its zoom factor as a C float.
+        def single(value):
+            return struct.unpack('f', struct.pack('f', value))[0]
+
+        def axis(start, end, size):
+            # Returns the best few ways of scaling [start, end) along
+            # one axis, as (error, padded start, padded length,
+            # scaled length, first scaled pixel to keep, pixels to
+            # keep, display position of the first), smallest error
+            # (in source pixels) first.
+            scaledSize = int(size * single(self.displayScale))
+            step = int(65536.0 * (size - 1) / scaledSize) / 65536.0
+
+            # The display pixels whose samples involve a source pixel
+            # within [start, end).
+            first = max(int((start - 1) / step), 0)
+            last = min(int(end / step) + 1, scaledSize)
+            count = last - first
+
+            # Try up to SOFT_TILE_SEARCH extra pixels of padding on
+            # each side, and scaled lengths either side of the nominal.
+            candidates = []
+            for padStart in range(max(start - SOFT_TILE_PAD - SOFT_TILE_SEARCH, 0),
+                                  max(start - SOFT_TILE_PAD, 0) + 1):
+                for padEnd in range(min(end + SOFT_TILE_PAD, size),
+                                    min(end + SOFT_TILE_PAD + SOFT_TILE_SEARCH, size) + 1):
+                    length = padEnd - padStart
+                    nominal = int((length - 1) / step + 0.5)
+                    for scaledLength in range(nominal - 1, nominal + 2):
+                        tileStep = int(65536.0 * (length - 1) / scaledLength) / 65536.0
+                        keep = int((first * step - padStart) / tileStep + 0.5)
+                        if keep < 0 or keep + count > scaledLength:
+                            continue
+                        error = max(abs(padStart + keep * tileStep - first * step),
+                                    abs(padStart + (keep + count - 1) * tileStep - (last - 1) * step))
+                        candidates.append((error, padStart, length, scaledLength,
+                                           keep, count, first))
+
+            # Prefer the least padding that is close enough.
+            candidates.sort(key = lambda c: (c[0] > SOFT_TILE_ERROR, c[2], c[0]))
+            return candidates[:30]
+
+        columns = [axis(TILE_HEIGHT * col, TILE_HEIGHT * (col + 1), CDG_DISPLAY_HEIGHT)
+                   for col in range(TILES_PER_COL)]
+        for row in range(TILES_PER_ROW):
+            xs = axis(TILE_WIDTH * row, TILE_WIDTH * (row + 1), CDG_DISPLAY_WIDTH)
+            for col in range(TILES_PER_COL):
+                ys = columns[col]
+
+                # rotozoom() only takes the one zoom factor, which has
+                # to give the chosen scaled size along both axes.
+                best = None
+                for x in xs:
+                    for y in ys:
+                        low = max(float(x[3]) / x[2], float(y[3]) / y[2])
+                        high = min(float(x[3] + 1) / x[2], float(y[3] + 1) / y[2])
+                        zoom = single((low + high) / 2)
+                        key = (max(x[0], y[0]) > SOFT_TILE_ERROR, x[2] * y[2], max(x[0], y[0]))
+                        if int(x[2] * zoom) == x[3] and int(y[2] * zoom) == y[3] and \
+                           (best is None or key < best[0]):
+                            best = (key, zoom, x, y)
+                if best is None:
+                    return None
+                key, zoom, x, y = best
+
+                srcRect = pygame.Rect(x[1], y[1], x[2], y[2])
+                area = pygame.Rect(x[4], y[4], x[5], y[5])
+                layout[(row, col)] = (srcRect, zoom, area, (x[6], y[6]))
+
+        return layout
+
+def closeSession():
+    """ Closes the pygame mixer and display left open by players with
+    keepSession set. """
+
+    pygame.mixer.quit()
+    pygame.display.quit()
+
+def rgbToYuv420(data, width, height):
+    """ Converts a frame of 24-bit RGB pixels (as given by
+    pygame.image.tostring()) to the Y, U and V planes of a YUV4MPEG2
+    C420jpeg frame, using the ITU-R BT.601 coefficients.  Each U and V
+    sample is taken from the average of a 2x2 block of pixels, so the
+    width and height must be even. """
+
+    rgb = N.reshape(N.fromstring(data, N.UnsignedInt8),
+                    (height, width, 3)).astype(N.Int)
+    r, g, b = rgb[:,:,0], rgb[:,:,1], rgb[:,:,2]
+    y = ((66 * r + 129 * g + 25 * b + 128) >> 8) + 16
+
+    # Average each 2x2 block before converting; the conversion is
+    # linear, so this is the same as averaging the U and V samples.
+    rgb = (rgb[0::2, 0::2] + rgb[0::2, 1::2] +
+           rgb[1::2, 0::2] + rgb[1::2, 1::2] + 2) >> 2
+    r, g, b = rgb[:,:,0], rgb[:,:,1], rgb[:,:,2]
+    u = ((-38 * r - 74 * g + 112 * b + 128) >> 8) + 128
+    v = ((112 * r - 94 * g - 18 * b + 128) >> 8) + 128
+
+    return y.astype(N.UnsignedInt8).tostring() + \
+           u.astype(N.UnsignedInt8).tostring() + \
+           v.astype(N.UnsignedInt8).tostring()
 
 def defaultErrorPrint(ErrorString):
     print (ErrorString)
@@ -76,16 +76,22 @@ TILE_HEIGHT             = CDG_DISPLAY_HEIGHT / TILES_PER_COL
 
 COLOUR_TABLE_SIZE       = 16
 
-class CdgPacket:
-    """ This class just represents a single 24-byte packet read from
-    the CDG stream.  It's not used outside this module. """
-    
-    def __init__(self, packetData):
-        self.command = packetData[0]
-        self.instruction = packetData[1]
-        #self.parityQ = packetData[2:4]
-        self.data = packetData[4:20]
-        #self.parity = packetData[20:24]
+# The decoder records a snapshot of its state every SNAPSHOT_INTERVAL
+# packets (10 seconds of CDG data) as it decodes the stream, so that
+# Seek() never has to replay more than this many packets.
+SNAPSHOT_INTERVAL       = 3000
+
+# When the decoder is asked to catch up by at least CATCHUP_PACKETS
+# packets at once (after a stall, say), it skips the pixel work of any
+# instruction that a later memory preset in the same batch will
+# overwrite anyway.
+CATCHUP_PACKETS         = 300
+
+# Bit expansion table for the tile block commands. Entry n holds the
+# six pixel bits of the 6-bit data byte n, leftmost pixel first, so
+# that a whole 6x12 tile can be expanded with a single take().
+TILE_BLOCK_BITS = N.array([[(n >> (5 - j)) & 0x01 for j in range(6)]
+                           for n in range(64)])
 
 class CdgPacketReader:
     """ This class does the all work of reading packets from the CDG
@@ -101,12 +107,80 @@ class CdgPacketReader:
     # closely, including duplicating the private members.)
     
     def __init__(self, cdgData, mapperSurface):
-        self.__cdgData = cdgData
-        self.__cdgDataPos = 0
+        # Parse the whole stream once into an (N, 24) array of packet
+        # bytes.  The command, instruction and data columns are then
+        # read directly during decoding, with no per-packet objects.
+        # Any trailing partial packet is ignored.
+        numPackets = len(cdgData) / 24
+        self.__cdgPackets = N.reshape(
+            N.fromstring(cdgData[:numPackets * 24], N.UnsignedInt8),
+            (numPackets, 24))
+        self.__cdgNumPackets = numPackets
+        self.__cdgCommands = self.__cdgPackets[:,0] & CDG_MASK
+        self.__cdgInstructions = self.__cdgPackets[:,1] & CDG_MASK
+        #self.__cdgParityQ = self.__cdgPackets[:,2:4]
+        self.__cdgPacketData = self.__cdgPackets[:,4:20]
+        #self.__cdgParity = self.__cdgPackets[:,20:24]
+        self.__cdgPacketPos = 0
+
+        # Most packets in a CDG stream are not CDG commands at all, so
+        # build a sorted index of the packets that are, once.  Decoding
+        # then jumps straight from one instruction to the next.
+        # __cdgNextInstruction is the position in this index of the
+        # first instruction at or after __cdgPacketPos.
+        self.__cdgInstructionIndex = N.compress(
+            self.__cdgCommands == CDG_COMMAND,
+            N.arange(numPackets)).tolist()
+        # The instruction code and first data byte (the colour) of
+        # each indexed packet, for the catch-up scan.
+        self.__cdgIndexInstructions = N.take(
+            self.__cdgInstructions, self.__cdgInstructionIndex, 0).tolist()
+        self.__cdgIndexColours = (N.take(
+            self.__cdgPacketData[:,0], self.__cdgInstructionIndex, 0) & 0x0F).tolist()
+        self.__cdgNextInstruction = 0
+
+        # Snapshots of the decoder state, keyed by packet position.
+        # These remain valid across Rewind(), since the stream itself
+        # doesn't change.
+        self.__snapshots = {}
 
         # This is just for the purpose of mapping colors.
         self.__mapperSurface = mapperSurface
 
+        # If the mapper surface is an 8-bit palettized surface, we run
+        # in palette mode: FillTile() writes the colour indeces
+        # themselves, and the colour table is handed out as a 16-entry
+        # RGB palette by GetDirtyPalette().  A colour table load then
+        # only changes the palette; no pixels need to be recomputed,
+        # and __cdgSurfarray is not maintained at all.
+        self.__paletted = (mapperSurface.get_bitsize() == 8)
+
+        # Allocate the pixel arrays once; all of the commands then
+        # work on them in place.  Each array has a spare buffer of the
+        # same shape, which scroll commands shift the pixels into
+        # before swapping the two over.
+
+        # Build a 300x216 array for the pixel indeces, including border
+        # area.  The indeces are 4-bit values, so one byte per pixel.
+        self.__cdgPixelColours = N.zeros((CDG_FULL_WIDTH, CDG_FULL_HEIGHT),
+                                         N.UnsignedInt8)
+        self.__cdgPixelColoursBuffer = N.zeros((CDG_FULL_WIDTH, CDG_FULL_HEIGHT),
+                                               N.UnsignedInt8)
+
+        # Build a 300x216 array for the actual RGB values. This will
+        # be changed by the various commands, and blitted to the
+        # screen now and again. But the border area will not be
+        # blitted, only the central 288x192 area.  Not needed at all
+        # in palette mode.  The mapped colours are at most 32 bits.
+        if self.__paletted:
+            self.__cdgSurfarray = None
+            self.__cdgSurfarrayBuffer = None
+        else:
+            self.__cdgSurfarray = N.zeros((CDG_FULL_WIDTH, CDG_FULL_HEIGHT),
+                                          N.UnsignedInt32)
+            self.__cdgSurfarrayBuffer = N.zeros((CDG_FULL_WIDTH, CDG_FULL_HEIGHT),
+                                                N.UnsignedInt32)
+
         self.Rewind()
         
     def Rewind(self):
@@ -114,13 +188,18 @@ class CdgPacketReader:
         internal state in preparation for decoding the tiles
         again. """
         
-        self.__cdgDataPos = 0
+        self.__cdgPacketPos = 0
+        self.__cdgNextInstruction = 0
 
         # Initialise the colour table. Set a default value for any
         # CDG files that don't actually load the colour table
         # before doing something with it.
-        defaultColour = 0
+        if self.__paletted:
+            defaultColour = (0, 0, 0)
+        else:
+            defaultColour = 0
         self.__cdgColourTable = [defaultColour] * COLOUR_TABLE_SIZE
+        self.__paletteChanged = True
 
         self.__justClearedColourIndex = -1
         self.__cdgPresetColourIndex = -1
@@ -138,14 +217,10 @@ class CdgPacketReader:
         self.__hOffset = 0
         self.__vOffset = 0
         
-        # Build a 306x228 array for the pixel indeces, including border area
-        self.__cdgPixelColours = N.zeros((CDG_FULL_WIDTH, CDG_FULL_HEIGHT))
-
-        # Build a 306x228 array for the actual RGB values. This will
-        # be changed by the various commands, and blitted to the
-        # screen now and again. But the border area will not be
-        # blitted, only the central 288x192 area.
-        self.__cdgSurfarray = N.zeros((CDG_FULL_WIDTH, CDG_FULL_HEIGHT))
+        # Clear the pixel index and RGB arrays
+        self.__cdgPixelColours[:,:] = 0
+        if not self.__paletted:
+            self.__cdgSurfarray[:,:] = 0
 
         # Start with all tiles requiring update
         self.__updatedTiles = 0xFFFFFFFFL
@@ -171,10 +246,21 @@ class CdgPacketReader:
         self.__updatedTiles = 0
         return tiles
 
+    def GetDirtyPalette(self):
+        """ In palette mode, returns the colour table as a list of 16
+        (r, g, b) tuples if it has changed since the last call, or
+        None if it has not.  Then resets the changed flag. """
+
+        if not self.__paletteChanged:
+            return None
+        self.__paletteChanged = False
+        return self.__cdgColourTable[:]
+
     def GetBorderColour(self):
         """ Returns the current border colour, as a mapped integer
-        ready to apply to the surface.  Returns None if the border
-        colour has not yet been specified by the CDG stream. """
+        (or an (r, g, b) tuple in palette mode) ready to apply to the
+        surface.  Returns None if the border colour has not yet been
+        specified by the CDG stream. """
         
         if self.__cdgBorderColourIndex == -1:
             return None
@@ -187,18 +273,50 @@ class CdgPacketReader:
         the end-of-file has been reached and no more packets can be
         processed."""
         
-        for i in range(numPackets):
-            # Extract the nexxt packet
-            packd = self.__getNextPacket()
-            if not packd:
-                # No more packets.  Return False, but only if we
-                # reached this condition on the first packet.
-                return (i != 0)
-
-            self.__cdgPacketProcess (packd)
+        pos = self.__cdgPacketPos
+        if pos >= self.__cdgNumPackets:
+            # No more packets.  Return False, but only if we were
+            # actually asked for some.
+            return (numPackets <= 0)
+
+        end = min(pos + numPackets, self.__cdgNumPackets)
+        while pos < end:
+            # Decode up to the next snapshot boundary (or the end of
+            # the requested range), and record a snapshot there if we
+            # haven't already got one.
+            boundary = (pos / SNAPSHOT_INTERVAL + 1) * SNAPSHOT_INTERVAL
+            pos = min(end, boundary)
+            self.__cdgProcessUntil(pos)
+            if pos == boundary and pos not in self.__snapshots:
+                self.__snapshots[pos] = self.__cdgSaveState()
 
         return True
 
+    def Seek(self, packetNum):
+        """ Moves the stream to the indicated packet, leaving the
+        internal tables exactly as if every packet up to that point
+        had been processed by DoPackets().  The state is restored from
+        the nearest recorded snapshot at or before packetNum, so that
+        only the packets after it need to be replayed.  All tiles are
+        marked dirty. """
+
+        packetNum = max(0, min(packetNum, self.__cdgNumPackets))
+        key = (packetNum / SNAPSHOT_INTERVAL) * SNAPSHOT_INTERVAL
+        while key > 0 and key not in self.__snapshots:
+            key -= SNAPSHOT_INTERVAL
+
+        if key <= self.__cdgPacketPos <= packetNum:
+            # We're already past the nearest snapshot; just carry on
+            # decoding from here.
+            pass
+        elif key == 0:
+            self.Rewind()
+        else:
+            self.__cdgRestoreState(self.__snapshots[key])
+
+        self.DoPackets(packetNum - self.__cdgPacketPos)
+        self.__updatedTiles = 0xFFFFFFFFL
+
     def FillTile(self, surface, row, col):
         """ Fills in the pixels on the indicated one-tile surface
         (which must be a TILE_WIDTH x TILE_HEIGHT sized surface) with
@@ -209,55 +327,160 @@ class CdgPacketReader:
         row_end = 6 + self.__hOffset + ((row + 1) * TILE_WIDTH)
         col_start = 12 + self.__vOffset + (col * TILE_HEIGHT)
         col_end = 12 + self.__vOffset + ((col + 1) * TILE_HEIGHT)
+        if self.__paletted:
+            pixels = self.__cdgPixelColours
+        else:
+            pixels = self.__cdgSurfarray
         pygame.surfarray.blit_array( \
             surface, \
-            self.__cdgSurfarray[row_start:row_end, col_start:col_end])
+            pixels[row_start:row_end, col_start:col_end])
 
 
     # The remaining methods are all private; they are not part of the
     # public interface.
 
-    # Read the next CDG command from the file (24 bytes each)
-    def __getNextPacket(self):
-        packetData = map(ord, self.__cdgData[self.__cdgDataPos : self.__cdgDataPos + 24])
-        self.__cdgDataPos += 24
-        if (len(packetData) == 24):
-            return CdgPacket(packetData)
+    # Process the instruction packets from the current position up to
+    # (but not including) packet number end; the other packets are
+    # skipped over without being touched.
+    def __cdgProcessUntil (self, end):
+        index = self.__cdgInstructionIndex
+        i = self.__cdgNextInstruction
+        if end - self.__cdgPacketPos >= CATCHUP_PACKETS:
+            # Catching up: everything before the last memory preset
+            # in this batch only needs its effect on the decoder
+            # state, not on the pixels.
+            last = self.__cdgFindLastPreset(i, end)
+            while i < last:
+                packet = index[i]
+                self.__cdgPacketElide (self.__cdgIndexInstructions[i],
+                                       self.__cdgPacketData[packet].tolist())
+                i += 1
+
+        while i < len(index) and index[i] < end:
+            packet = index[i]
+            self.__cdgPacketProcess (self.__cdgInstructions[packet],
+                                     self.__cdgPacketData[packet].tolist())
+            i += 1
+
+        self.__cdgNextInstruction = i
+        self.__cdgPacketPos = end
+
+    # Return the position in the instruction index of the last memory
+    # preset before packet number end that will actually clear the
+    # screen, starting from instruction i; or i if there is none.
+    # (A preset to the colour the screen was just cleared to, with no
+    # tile blocks since, does nothing.)  That preset overwrites every
+    # pixel, border included, so the pixel work of everything before
+    # it can be skipped.
+    def __cdgFindLastPreset (self, i, end):
+        index = self.__cdgInstructionIndex
+        instructions = self.__cdgIndexInstructions
+        colours = self.__cdgIndexColours
+        justCleared = self.__justClearedColourIndex
+        last = i
+        while i < len(index) and index[i] < end:
+            inst_code = instructions[i]
+            if inst_code == CDG_INST_MEMORY_PRESET:
+                if colours[i] != justCleared:
+                    justCleared = colours[i]
+                    last = i
+            elif inst_code == CDG_INST_TILE_BLOCK or \
+                 inst_code == CDG_INST_TILE_BLOCK_XOR:
+                justCleared = -1
+            i += 1
+        return last
+
+    # Apply the indicated instruction to the decoder state only,
+    # leaving the pixels alone.  Used for the instructions whose pixels
+    # will be overwritten by a later memory preset.
+    def __cdgPacketElide (self, inst_code, data):
+        if inst_code == CDG_INST_MEMORY_PRESET:
+            colour = data[0] & 0x0F
+            if colour != self.__justClearedColourIndex:
+                self.__justClearedColourIndex = colour
+                self.__cdgPresetColourIndex = colour
+                self.__cdgBorderColourIndex = colour
+        elif inst_code == CDG_INST_BORDER_PRESET:
+            self.__cdgBorderColourIndex = data[0] & 0x0F
+        elif inst_code == CDG_INST_TILE_BLOCK or \
+             inst_code == CDG_INST_TILE_BLOCK_XOR:
+            self.__justClearedColourIndex = -1
+        elif inst_code == CDG_INST_SCROLL_PRESET or \
+             inst_code == CDG_INST_SCROLL_COPY:
+            self.__cdgScrollOffsets (data)
+        elif inst_code == CDG_INST_LOAD_COL_TBL_0_7:
+            self.__cdgSetColourTable (data, 0)
+        elif inst_code == CDG_INST_LOAD_COL_TBL_8_15:
+            self.__cdgSetColourTable (data, 1)
         else:
-            self.__cdgDataPos = len(self.__cdgData)
-            return None
+            self.__cdgPacketProcess (inst_code, data)
+
+    # Return a compact copy of everything needed to resume decoding
+    # from the current position: the pixel indeces, colour table,
+    # colour indeces and screen offsets.  The RGB surfarray is not
+    # saved, since it can be recomputed from these.
+    def __cdgSaveState (self):
+        return (self.__cdgPacketPos,
+                self.__cdgNextInstruction,
+                N.array(self.__cdgPixelColours),
+                self.__cdgColourTable[:],
+                self.__justClearedColourIndex,
+                self.__cdgPresetColourIndex,
+                self.__cdgBorderColourIndex,
+                self.__cdgTransparentColour,
+                self.__hOffset,
+                self.__vOffset)
+
+    # Restore a state previously returned by __cdgSaveState().
+    def __cdgRestoreState (self, state):
+        (self.__cdgPacketPos,
+         self.__cdgNextInstruction,
+         pixelColours,
+         colourTable,
+         self.__justClearedColourIndex,
+         self.__cdgPresetColourIndex,
+         self.__cdgBorderColourIndex,
+         self.__cdgTransparentColour,
+         self.__hOffset,
+         self.__vOffset) = state
+        self.__cdgColourTable = colourTable[:]
+        self.__cdgPixelColours[:,:] = pixelColours
+        if not self.__paletted:
+            lookupTable = N.array(self.__cdgColourTable)
+            self.__cdgSurfarray.flat[:] = N.take(lookupTable, N.ravel(self.__cdgPixelColours))
+        self.__paletteChanged = True
+        self.__updatedTiles = 0xFFFFFFFFL
 
-    # Decode and perform the CDG commands in the indicated packet.
-    def __cdgPacketProcess (self, packd):
-        if (packd.command & CDG_MASK) == CDG_COMMAND:
-            inst_code = (packd.instruction & CDG_MASK)
-            if inst_code == CDG_INST_MEMORY_PRESET:
-                self.__cdgMemoryPreset (packd)
-            elif inst_code == CDG_INST_BORDER_PRESET:
-                self.__cdgBorderPreset (packd)
-            elif inst_code == CDG_INST_TILE_BLOCK:
-                self.__cdgTileBlockCommon(packd, xor = 0)
-            elif inst_code == CDG_INST_SCROLL_PRESET:
-                self.__cdgScrollPreset (packd)
-            elif inst_code == CDG_INST_SCROLL_COPY:
-                self.__cdgScrollCopy (packd)
-            elif inst_code == CDG_INST_DEF_TRANSP_COL:
-                self.__cdgDefineTransparentColour (packd)
-            elif inst_code == CDG_INST_LOAD_COL_TBL_0_7:
-                self.__cdgLoadColourTableCommon (packd, 0)
-            elif inst_code == CDG_INST_LOAD_COL_TBL_8_15:
-                self.__cdgLoadColourTableCommon (packd, 1)
-            elif inst_code == CDG_INST_TILE_BLOCK_XOR:
-                self.__cdgTileBlockCommon(packd, xor = 1)
-            else:
-                # Don't use the error popup, ignore the unsupported command
-                ErrorString = "CDG file may be corrupt, cmd: " + str(inst_code)
-                print (ErrorString)
+    # Perform the CDG instruction in the indicated packet, given its
+    # instruction code and its 16 data bytes.
+    def __cdgPacketProcess (self, inst_code, data):
+        if inst_code == CDG_INST_MEMORY_PRESET:
+            self.__cdgMemoryPreset (data)
+        elif inst_code == CDG_INST_BORDER_PRESET:
+            self.__cdgBorderPreset (data)
+        elif inst_code == CDG_INST_TILE_BLOCK:
+            self.__cdgTileBlockCommon(data, xor = 0)
+        elif inst_code == CDG_INST_SCROLL_PRESET:
+            self.__cdgScrollPreset (data)
+        elif inst_code == CDG_INST_SCROLL_COPY:
+            self.__cdgScrollCopy (data)
+        elif inst_code == CDG_INST_DEF_TRANSP_COL:
+            self.__cdgDefineTransparentColour (data)
+        elif inst_code == CDG_INST_LOAD_COL_TBL_0_7:
+            self.__cdgLoadColourTableCommon (data, 0)
+        elif inst_code == CDG_INST_LOAD_COL_TBL_8_15:
+            self.__cdgLoadColourTableCommon (data, 1)
+        elif inst_code == CDG_INST_TILE_BLOCK_XOR:
+            self.__cdgTileBlockCommon(data, xor = 1)
+        else:
+            # Don't use the error popup, ignore the unsupported command
+            ErrorString = "CDG file may be corrupt, cmd: " + str(inst_code)
+            print (ErrorString)
 
     # Memory preset (clear the viewable area + border)
-    def __cdgMemoryPreset (self, packd):
-        colour = packd.data[0] & 0x0F
-        repeat = packd.data[1] & 0x0F
+    def __cdgMemoryPreset (self, data):
+        colour = data[0] & 0x0F
+        repeat = data[1] & 0x0F
 
         # The "repeat" flag is nonzero if this is a repeat of a
         # previously-appearing preset command.  (Often a CDG will
@@ -296,22 +519,19 @@ class CdgPacketReader:
         # screen, and the stripes of 12 pixels on the top and bottom
         # of the screen.
         
-        # The most efficient way of setting the values in a Numeric
-        # array, is to create a zero array and do addition on the
-        # the border and preset slices.
-        self.__cdgPixelColours = N.zeros([CDG_FULL_WIDTH, CDG_FULL_HEIGHT])
-        self.__cdgPixelColours[:,:] = self.__cdgPixelColours[:,:] + colour
+        # Fill the preallocated array in place.
+        self.__cdgPixelColours[:,:] = colour
         
         # Now set the border and preset colour in our local surfarray. 
         # This will be blitted next time there is a screen update.
-        self.__cdgSurfarray = N.zeros([CDG_FULL_WIDTH, CDG_FULL_HEIGHT])
-        self.__cdgSurfarray[:,:] = self.__cdgSurfarray[:,:] + self.__cdgColourTable[colour]
+        if not self.__paletted:
+            self.__cdgSurfarray[:,:] = self.__cdgColourTable[colour]
 
         self.__updatedTiles = 0xFFFFFFFFL
 
     # Border Preset (clear the border area only) 
-    def __cdgBorderPreset (self, packd):
-        colour = packd.data[0] & 0x0F
+    def __cdgBorderPreset (self, data):
+        colour = data[0] & 0x0F
         if colour == self.__cdgBorderColourIndex:
             return
         
@@ -320,45 +540,50 @@ class CdgPacketReader:
         # See cdgMemoryPreset() for a description of what's going on.
         # In this case we are only clearing the border area.
 
-        # Set up the border area of the pixel colours array
-        self.__cdgPixelColours[:,:12] = N.zeros([CDG_FULL_WIDTH, 12])
-        self.__cdgPixelColours[:,:12] = self.__cdgPixelColours[:,:12] + self.__cdgBorderColourIndex
-        self.__cdgPixelColours[:,-12:] = N.zeros([CDG_FULL_WIDTH, 12])
-        self.__cdgPixelColours[:,-12:] = self.__cdgPixelColours[:,-12:] + self.__cdgBorderColourIndex
-        self.__cdgPixelColours[:6,12:-12] = N.zeros([6, CDG_FULL_HEIGHT - 24]) 
-        self.__cdgPixelColours[:6,12:-12] = self.__cdgPixelColours[:6,12:-12] + self.__cdgBorderColourIndex
-        self.__cdgPixelColours[-6:,12:-12] = N.zeros([6, CDG_FULL_HEIGHT - 24]) 
-        self.__cdgPixelColours[-6:,12:-12] = self.__cdgPixelColours[-6:,12:-12] + self.__cdgBorderColourIndex
-
-        # Now that we have set the PixelColours, apply them to
-        # the Surfarray.
-        lookupTable = N.array(self.__cdgColourTable)
-        self.__cdgSurfarray.flat[:] = N.take(lookupTable, N.ravel(self.__cdgPixelColours))
+        # Set up the border area of the pixel colours array, and the
+        # same area of the Surfarray.
+        self.__cdgFillBorder(self.__cdgPixelColours, colour)
+        if not self.__paletted:
+            self.__cdgFillBorder(self.__cdgSurfarray, self.__cdgColourTable[colour])
+
+        # With the screen shifted, the tiles at the right or bottom
+        # edge show some of the border, so they need updating too.
+        if self.__hOffset:
+            for col in range(TILES_PER_COL):
+                self.__updatedTiles |= ((1 << (TILES_PER_ROW - 1)) << (col * 8))
+        if self.__vOffset:
+            self.__updatedTiles |= (((1 << TILES_PER_ROW) - 1) << ((TILES_PER_COL - 1) * 8))
 
         return
 
+    # Fill the border area (the 12-pixel stripes at the top and bottom
+    # and the 6-pixel stripes at the left and right) of the indicated
+    # array with a single value.
+    def __cdgFillBorder (self, array, value):
+        array[:,:12] = value
+        array[:,-12:] = value
+        array[:6,12:-12] = value
+        array[-6:,12:-12] = value
+
     # CDG Scroll Command - Set the scrolled in area with a fresh colour
-    def __cdgScrollPreset (self, packd):
-        self.__cdgScrollCommon (packd, copy = False)
+    def __cdgScrollPreset (self, data):
+        self.__cdgScrollCommon (data, copy = False)
         return
 
     # CDG Scroll Command - Wrap the scrolled out area into the opposite side
-    def __cdgScrollCopy (self, packd):
-        self.__cdgScrollCommon (packd, copy = True)
+    def __cdgScrollCopy (self, data):
+        self.__cdgScrollCommon (data, copy = True)
         return
 
     # Common function to handle the actual pixel scroll for Copy and Preset
-    def __cdgScrollCommon (self, packd, copy):
+    def __cdgScrollCommon (self, data, copy):
 
         # Decode the scroll command parameters
-        data_block = packd.data
-        colour = data_block[0] & 0x0F
-        hScroll = data_block[1] & 0x3F
-        vScroll = data_block[2] & 0x3F
+        colour = data[0] & 0x0F
+        hScroll = data[1] & 0x3F
+        vScroll = data[2] & 0x3F
         hSCmd = (hScroll & 0x30) >> 4
-        hOffset = (hScroll & 0x07)
         vSCmd = (vScroll & 0x30) >> 4
-        vOffset = (vScroll & 0x0F)
 
         # Scroll Vertical - Calculate number of pixels
         vScrollUpPixels = 0
@@ -376,11 +601,7 @@ class CdgPacketReader:
         elif hSCmd == 1:
             hScrollRightPixels = 6
 
-        if hOffset != self.__hOffset or vOffset != self.__vOffset:
-            # Changing the screen shift.
-            self.__hOffset = min(hOffset, 5)
-            self.__vOffset = min(vOffset, 11)
-            self.__updatedTiles = 0xFFFFFFFFL
+        self.__cdgScrollOffsets (data)
 
         if hScrollLeftPixels == 0 and \
            hScrollRightPixels == 0 and \
@@ -389,69 +610,100 @@ class CdgPacketReader:
             # Never mind.
             return
 
-        # Perform the actual scroll. Use surfarray and slicing to make
-        # this efficient. A copy scroll (where the data scrolls round)
-        # can be achieved by slicing and concatenating again.
-        # For non-copy, the new slice is filled in with a new colour.
-        if (copy == True):
-            if (vScrollUpPixels > 0):
-                self.__cdgPixelColours = N.concatenate((self.__cdgPixelColours[:,vScrollUpPixels:], self.__cdgPixelColours[:,:vScrollUpPixels]), 1)
-            elif (vScrollDownPixels > 0):
-                self.__cdgPixelColours = N.concatenate((self.__cdgPixelColours[:,-vScrollDownPixels:], self.__cdgPixelColours[:,:-vScrollDownPixels]), 1)
-            elif (hScrollLeftPixels > 0):
-                self.__cdgPixelColours = N.concatenate((self.__cdgPixelColours[hScrollLeftPixels:,:], self.__cdgPixelColours[:hScrollLeftPixels,:]), 0)
-            elif (hScrollRightPixels > 0):
-                self.__cdgPixelColours = N.concatenate((self.__cdgPixelColours[-hScrollRightPixels:,:], self.__cdgPixelColours[:-hScrollRightPixels,:]), 0)
-        elif (copy == False):
-            if (vScrollUpPixels > 0):
-                copyBlockActualColour = N.zeros([CDG_FULL_WIDTH,vScrollUpPixels]) + self.__cdgColourTable[colour]
-                copyBlockColourIndex = N.zeros([CDG_FULL_WIDTH,vScrollUpPixels]) + colour
-                self.__cdgPixelColours = N.concatenate((self.__cdgPixelColours[:,vScrollUpPixels:], copyBlockColourIndex), 1)
-            elif (vScrollDownPixels > 0):
-                copyBlockActualColour = N.zeros([CDG_FULL_WIDTH,vScrollDownPixels]) + self.__cdgColourTable[colour]
-                copyBlockColourIndex = N.zeros([CDG_FULL_WIDTH,vScrollDownPixels]) + colour
-                self.__cdgPixelColours = N.concatenate((copyBlockColourIndex, self.__cdgPixelColours[:,:-vScrollDownPixels]), 1)
-            elif (hScrollLeftPixels > 0):
-                copyBlockActualColour = N.zeros([hScrollLeftPixels, CDG_FULL_HEIGHT]) + self.__cdgColourTable[colour]
-                copyBlockColourIndex = N.zeros([hScrollLeftPixels, CDG_FULL_HEIGHT]) + colour
-                self.__cdgPixelColours = N.concatenate((self.__cdgPixelColours[hScrollLeftPixels:,:], copyBlockColourIndex), 0)
-            elif (hScrollRightPixels > 0):
-                copyBlockActualColour = N.zeros([hScrollRightPixels, CDG_FULL_HEIGHT]) + self.__cdgColourTable[colour]
-                copyBlockColourIndex = N.zeros([hScrollRightPixels, CDG_FULL_HEIGHT]) + colour
-                self.__cdgPixelColours = N.concatenate((copyBlockColourIndex, self.__cdgPixelColours[:-hScrollRightPixels,:]), 0)
-
-        # Now that we have scrolled the PixelColours, apply them to
-        # the Surfarray.
-        
-        lookupTable = N.array(self.__cdgColourTable)
-        self.__cdgSurfarray.flat[:] = N.take(lookupTable, N.ravel(self.__cdgPixelColours))
+        if vScrollUpPixels > 0:
+            dx, dy = 0, -vScrollUpPixels
+        elif vScrollDownPixels > 0:
+            dx, dy = 0, vScrollDownPixels
+        elif hScrollLeftPixels > 0:
+            dx, dy = -hScrollLeftPixels, 0
+        else:
+            dx, dy = hScrollRightPixels, 0
+
+        # Perform the actual scroll. A copy scroll (where the data
+        # scrolls round) wraps the scrolled out pixels into the
+        # opposite side; for non-copy, the new slice is filled in with
+        # a new colour.  The pixels are shifted into the spare buffer,
+        # which then becomes the current array, so that nothing is
+        # allocated.  The Surfarray is scrolled in exactly the same
+        # way, so it still matches the PixelColours afterwards.
+        if copy:
+            fillIndex = None
+            fillColour = None
+        else:
+            fillIndex = colour
+            fillColour = self.__cdgColourTable[colour]
+
+        self.__cdgShiftArray(self.__cdgPixelColours,
+                             self.__cdgPixelColoursBuffer,
+                             dx, dy, fillIndex)
+        self.__cdgPixelColours, self.__cdgPixelColoursBuffer = \
+            self.__cdgPixelColoursBuffer, self.__cdgPixelColours
+
+        if not self.__paletted:
+            self.__cdgShiftArray(self.__cdgSurfarray,
+                                 self.__cdgSurfarrayBuffer,
+                                 dx, dy, fillColour)
+            self.__cdgSurfarray, self.__cdgSurfarrayBuffer = \
+                self.__cdgSurfarrayBuffer, self.__cdgSurfarray
         
         # We have modified our local cdgSurfarray. This will be blitted to
         # the screen by cdgDisplayUpdate()
         self.__updatedTiles = 0xFFFFFFFFL
 
+    # Apply the screen shift given in a scroll command.
+    def __cdgScrollOffsets (self, data):
+        hOffset = (data[1] & 0x07)
+        vOffset = (data[2] & 0x0F)
+        if hOffset != self.__hOffset or vOffset != self.__vOffset:
+            # Changing the screen shift.
+            self.__hOffset = min(hOffset, 5)
+            self.__vOffset = min(vOffset, 11)
+            self.__updatedTiles = 0xFFFFFFFFL
+
+    # Copy the indicated array into the same-sized dst array, shifted
+    # by dx pixels horizontally or dy pixels vertically (only one of
+    # which is nonzero).  The area shifted in on the opposite side is
+    # wrapped round from the pixels shifted out if fill is None, or
+    # else set to fill.
+    def __cdgShiftArray (self, src, dst, dx, dy, fill):
+        if dy:
+            n = abs(dy)
+            if dy < 0:
+                keep, into, wrap, edge = slice(n, None), slice(None, -n), slice(None, n), slice(-n, None)
+            else:
+                keep, into, wrap, edge = slice(None, -n), slice(n, None), slice(-n, None), slice(None, n)
+            dst[:,into] = src[:,keep]
+            if fill is None:
+                dst[:,edge] = src[:,wrap]
+            else:
+                dst[:,edge] = fill
+        else:
+            n = abs(dx)
+            if dx < 0:
+                keep, into, wrap, edge = slice(n, None), slice(None, -n), slice(None, n), slice(-n, None)
+            else:
+                keep, into, wrap, edge = slice(None, -n), slice(n, None), slice(-n, None), slice(None, n)
+            dst[into,:] = src[keep,:]
+            if fill is None:
+                dst[edge,:] = src[wrap,:]
+            else:
+                dst[edge,:] = fill
+
     # Set one of the colour indeces as transparent. Don't actually do anything with this
     # at the moment, as there is currently no mechanism for overlaying onto a movie file.
-    def __cdgDefineTransparentColour (self, packd):
-        data_block = packd.data
-        colour = data_block[0] & 0x0F
+    def __cdgDefineTransparentColour (self, data):
+        colour = data[0] & 0x0F
         self.__cdgTransparentColour = colour
         return
 
     # Load the RGB value for colours 0..7 or 8..15 in the lookup table
-    def __cdgLoadColourTableCommon (self, packd, table):
-        if table == 0:
-            colourTableStart = 0
-        else:
-            colourTableStart = 8
-        for i in range(8):
-            colourEntry = ((packd.data[2 * i] & CDG_MASK) << 8)
-            colourEntry = colourEntry + (packd.data[(2 * i) + 1] & CDG_MASK)
-            colourEntry = ((colourEntry & 0x3F00) >> 2) | (colourEntry & 0x003F)
-            red = ((colourEntry & 0x0F00) >> 8) * 17
-            green = ((colourEntry & 0x00F0) >> 4) * 17
-            blue = ((colourEntry & 0x000F)) * 17
-            self.__cdgColourTable[i + colourTableStart] = self.__mapperSurface.map_rgb(red, green, blue)
+    def __cdgLoadColourTableCommon (self, data, table):
+        self.__cdgSetColourTable (data, table)
+        if self.__paletted:
+            # In palette mode the pixels keep their colour indeces, so
+            # only the palette needs to be handed out again.
+            return
+
         # Redraw the entire screen using the new colour table. We still use the 
         # same colour indeces (0 to 15) at each pixel but these may translate to
         # new RGB colours. This handles CDGs that preset the screen before actually
@@ -472,14 +724,34 @@ class CdgPacketReader:
         self.__updatedTiles = 0xFFFFFFFFL
         return
 
+    # Store the RGB values for colours 0..7 or 8..15 in the lookup table
+    def __cdgSetColourTable (self, data, table):
+        if table == 0:
+            colourTableStart = 0
+        else:
+            colourTableStart = 8
+        for i in range(8):
+            colourEntry = ((data[2 * i] & CDG_MASK) << 8)
+            colourEntry = colourEntry + (data[(2 * i) + 1] & CDG_MASK)
+            colourEntry = ((colourEntry & 0x3F00) >> 2) | (colourEntry & 0x003F)
+            red = ((colourEntry & 0x0F00) >> 8) * 17
+            green = ((colourEntry & 0x00F0) >> 4) * 17
+            blue = ((colourEntry & 0x000F)) * 17
+            if self.__paletted:
+                self.__cdgColourTable[i + colourTableStart] = (red, green, blue)
+            else:
+                self.__cdgColourTable[i + colourTableStart] = self.__mapperSurface.map_rgb(red, green, blue)
+
+        if self.__paletted:
+            self.__paletteChanged = True
+
     # Set the colours for a 12x6 tile. The main CDG command for display data
-    def __cdgTileBlockCommon(self, packd, xor):
+    def __cdgTileBlockCommon(self, data, xor):
         # Decode the command parameters
-        data_block = packd.data
-        colour0 = data_block[0] & 0x0F
-        colour1 = data_block[1] & 0x0F
-        column_index = ((data_block[2] & 0x1F) * 12)
-        row_index = ((data_block[3] & 0x3F) * 6)
+        colour0 = data[0] & 0x0F
+        colour1 = data[1] & 0x0F
+        column_index = ((data[2] & 0x1F) * 12)
+        row_index = ((data[3] & 0x3F) * 6)
 
         # Sanity check the x,y offset read from the CDG in case a 
         # corrupted CDG sends us outside of our array bounds
@@ -508,34 +780,29 @@ class CdgPacketReader:
             for row in range(firstRow, lastRow + 1):
                 self.__updatedTiles |= ((1 << row) << (col * 8))
 
-        # Set the pixel array for each of the pixels in the 12x6 tile.
+        # Set the pixel array for the whole 6x12 tile at once.
         # Normal = Set the colour to either colour0 or colour1 depending
         #          on whether the pixel value is 0 or 1.
         # XOR    = XOR the colour with the colour index currently there.
-        for i in range (12):
-            byte = (data_block[4 + i] & 0x3F)
-            for j in range (6):
-                pixel = (byte >> (5 - j)) & 0x01
-                if xor:
-                    # Tile Block XOR
-                    if (pixel == 0):
-                        xor_col = colour0
-                    else:
-                        xor_col = colour1
-                    # Get the colour index currently at this location, and xor with it
-                    currentColourIndex = self.__cdgPixelColours[(row_index + j), (column_index + i)]
-                    new_col = currentColourIndex ^ xor_col
-                else:
-                    # Tile Block Normal
-                    if (pixel == 0):
-                        new_col = colour0
-                    else:
-                        new_col = colour1
-                # Set the pixel with the new colour. We set both the surfarray
-                # containing actual RGB values, as well as our array containing
-                # the colour indeces into our colour table.
-                self.__cdgSurfarray[(row_index + j), (column_index + i)] = self.__cdgColourTable[new_col]
-                self.__cdgPixelColours[(row_index + j), (column_index + i)] = new_col
+        # The bit expansion table turns the 12 data bytes into a 12x6
+        # array of pixel bits, which is transposed to match the
+        # (x, y) layout of our arrays.
+        bits = N.take(TILE_BLOCK_BITS, N.array(data[4:16]) & 0x3F, 0)
+        block = N.transpose(N.where(bits, colour1, colour0))
+        row_end = row_index + 6
+        column_end = column_index + 12
+        if xor:
+            # Get the colour indeces currently at this location, and
+            # xor with them
+            block = self.__cdgPixelColours[row_index:row_end, column_index:column_end] ^ block
+
+        # Set the pixels with the new colours. We set both the surfarray
+        # containing actual RGB values, as well as our array containing
+        # the colour indeces into our colour table.
+        if not self.__paletted:
+            lookupTable = N.array(self.__cdgColourTable)
+            self.__cdgSurfarray[row_index:row_end, column_index:column_end] = N.take(lookupTable, block, 0)
+        self.__cdgPixelColours[row_index:row_end, column_index:column_end] = block
 
         # Now the screen has some data on it, so a subsequent clear
         # should be respected.
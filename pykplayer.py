@@ -32,6 +32,72 @@ import os
 
 manager = Mock()
 
+# pykClock steers towards the position reported by the audio device by
+# speeding up or slowing down, correcting an error over about
+# CLOCK_SLEW_MS, but never by more than CLOCK_MAX_SLEW.  An error of
+# more than CLOCK_JUMP_MS is corrected at once.
+CLOCK_SLEW_MS       = 2000.0
+CLOCK_MAX_SLEW      = 0.05
+CLOCK_JUMP_MS       = 500
+
+class pykClock:
+    """ The playback clock: the current position through the song, in
+    milliseconds.  It runs from pygame.time.get_ticks(), so it advances
+    smoothly between calls and does not go backwards on its own.  The
+    audio device's idea of the position is fed in with Sync(); the
+    clock drifts gently towards it, or jumps to it if it is far off.
+    Negative positions, which SDL_mixer reports now and then, are
+    ignored. """
+
+    def __init__(self):
+        self.Reset()
+
+    def Reset(self, pos = 0):
+        """ Stops the clock at the indicated position. """
+        self.running = False
+        self.basePos = pos
+        self.baseTicks = pygame.time.get_ticks()
+        self.rate = 1.0
+
+    def Start(self):
+        if not self.running:
+            self.baseTicks = pygame.time.get_ticks()
+            self.running = True
+
+    def Stop(self):
+        if self.running:
+            self.basePos = self.GetPos()
+            self.rate = 1.0
+            self.running = False
+
+    def SetPos(self, pos):
+        """ Moves the clock to the indicated position, without
+        starting or stopping it. """
+        self.basePos = pos
+        self.baseTicks = pygame.time.get_ticks()
+        self.rate = 1.0
+
+    def GetPos(self):
+        if not self.running:
+            return int(self.basePos)
+        return int(self.basePos + (pygame.time.get_ticks() - self.baseTicks) * self.rate)
+
+    def Sync(self, pos):
+        """ Steers the clock towards pos, the position reported by the
+        audio device. """
+        if not self.running or pos < 0:
+            return
+        ticks = pygame.time.get_ticks()
+        current = self.basePos + (ticks - self.baseTicks) * self.rate
+        error = pos - current
+        if abs(error) > CLOCK_JUMP_MS:
+            self.basePos = pos
+            self.rate = 1.0
+        else:
+            self.basePos = current
+            self.rate = 1.0 + max(-CLOCK_MAX_SLEW, min(error / CLOCK_SLEW_MS, CLOCK_MAX_SLEW))
+        self.baseTicks = ticks
+
 class pykPlayer:
     def __init__(
             self, 
@@ -92,21 +158,12 @@ class pykPlayer:
         self.State = STATE_INIT
         self.InternalOffsetTime = 0
 
-        # These values are used to keep track of the current position
-        # through the song based on pygame's get_ticks() interface.
-        # It's used only when get_pos() cannot be used or is
-        # unreliable for some reason.
-        self.PlayTime = 0
-        self.PlayStartTime = 0
+        # The current position through the song.  It runs while
+        # State == STATE_PLAYING; players with an audio device keep it
+        # in step with the device using clock.Sync().
+        self.clock = pykClock()
         self.PlayFrame = 0
 
-        # self.PlayStartTime is valid while State == STATE_PLAYING; it
-        # indicates the get_ticks() value at which the song started
-        # (adjusted for any pause intervals that occurred during
-        # play).  self.PlayTime is valid while State != STATE_PLAYING;
-        # it indicates the total number of ticks (milliseconds) that
-        # have elapsed in the song so far.
-
         # self.PlayFrame starts at 0 and increments once for each
         # frame.  It's not very meaningful, except in STATE_CAPTURING
         # mode.
@@ -130,18 +187,18 @@ class pykPlayer:
 
     def Play(self):
         self.doPlay()
-        self.PlayStartTime = pygame.time.get_ticks()
+        self.clock.Start()
         self.State = STATE_PLAYING
 
     # Pause the song - Use Pause() again to unpause
     def Pause(self):
         if self.State == STATE_PLAYING:
             self.doPause()
-            self.PlayTime = pygame.time.get_ticks() - self.PlayStartTime
+            self.clock.Stop()
             self.State = STATE_PAUSED
         elif self.State == STATE_PAUSED:
             self.doUnpause()
-            self.PlayStartTime = pygame.time.get_ticks() - self.PlayTime
+            self.clock.Start()
             self.State = STATE_PLAYING
 
     # Close the whole thing down
@@ -151,8 +208,7 @@ class pykPlayer:
     # you must call Play() to restart. Blocks until pygame is initialised
     def Rewind(self):
         self.doRewind()
-        self.PlayTime = 0
-        self.PlayStartTime = 0
+        self.clock.Reset()
         self.PlayFrame = 0
         self.State = STATE_NOT_PLAYING
 
@@ -170,10 +226,7 @@ class pykPlayer:
 
     # Get the current time (in milliseconds).
     def GetPos(self):
-        if self.State == STATE_PLAYING:
-            return pygame.time.get_ticks() - self.PlayStartTime
-        else:
-            return self.PlayTime
+        return self.clock.GetPos()
 
     def SetupOptions(self, usage = None):
         """ Initialise and return optparse OptionParser object,
@@ -216,7 +269,7 @@ class pykPlayer:
             self.doFrameDump()
 
             # Set the frame time for the next frame.
-            self.PlayTime = 1000.0 * self.PlayFrame / self.dumpFrameRate
+            self.clock.SetPos(1000.0 * (self.PlayFrame + 1) / self.dumpFrameRate)
             
         self.PlayFrame += 1
         